@@ -0,0 +1,8 @@
+"""
+Repeatable benchmarks for django-cms-saq.
+
+``saq_generate_data`` builds a synthetic questionnaire (see ``data``) and
+``saq_benchmark`` times the submit and scores views, each plugin's render,
+the template tags and the aggregate scoring functions against it (see
+``cases``), reporting wall time, query counts and peak memory as JSON.
+"""
@@ -0,0 +1,199 @@
+"""Benchmark cases and the harness that times them."""
+import os
+import random
+import time
+import traceback
+
+from django.contrib.auth.models import User
+from django.db import connections, reset_queries
+from django.template import Template, RequestContext
+from django.test.client import RequestFactory
+from django.utils import simplejson
+
+from cms.models import Page
+from cms_saq import views
+from cms_saq.benchmarks.data import root_reverse_id
+from cms_saq.catalog import catalog
+from cms_saq.models import Question, Submission, SectionedScoring, ProgressBar, FormNav, \
+        BulkAnswer, aggregate_score_for_user_by_tags, aggregate_scores_for_users_by_tags
+from cms_saq.routers import shards
+
+try:
+    from cms_saq.cohort import CohortScores
+except ImportError:  # NumPy isn't installed
+    CohortScores = None
+
+
+def _run(name, func, iterations, warmup):
+    for i in range(warmup):
+        func()
+    for alias in connections:
+        connections[alias].use_debug_cursor = True
+    reset_queries()
+    try:
+        started = time.time()
+        for i in range(iterations):
+            func()
+        elapsed = time.time() - started
+        queries = sum([len(connections[alias].queries) for alias in connections])
+    finally:
+        for alias in connections:
+            connections[alias].use_debug_cursor = None
+        reset_queries()
+    return {
+        'name': name,
+        'iterations': iterations,
+        'wall_time': elapsed,
+        'wall_time_per_iteration': elapsed / iterations,
+        'queries_per_iteration': float(queries) / iterations,
+    }
+
+
+def measure(name, func, iterations, warmup=1):
+    """Run ``func`` ``warmup`` times untimed, then ``iterations`` times,
+    counting queries (on every database), wall time and peak memory.
+
+    ``ru_maxrss`` never goes down, so each case runs in a forked child and
+    reports the child's own peak.  Without ``fork`` the case runs in this
+    process and no peak is reported."""
+    if not hasattr(os, 'fork'):
+        return dict(_run(name, func, iterations, warmup), peak_memory_kb=None)
+    # the child mustn't share (and later close) this process's connections
+    for connection in connections.all():
+        connection.close()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        status = 0
+        try:
+            try:
+                result = _run(name, func, iterations, warmup)
+            except Exception:
+                result = {'error': traceback.format_exc()}
+                status = 1
+            out = os.fdopen(write, 'w')
+            out.write(simplejson.dumps(result))
+            out.close()
+        finally:
+            os._exit(status)
+    os.close(write)
+    inp = os.fdopen(read)
+    result = simplejson.loads(inp.read() or '{}')
+    inp.close()
+    pid, status, usage = os.wait4(pid, 0)
+    if status or 'error' in result:
+        raise RuntimeError("Benchmark %s failed:\n%s" % (name, result.get('error', status)))
+    result['peak_memory_kb'] = usage.ru_maxrss
+    return result
+
+
+class Cases(object):
+    """The benchmark cases for the data generated with ``prefix``."""
+
+    def __init__(self, prefix, seed=0):
+        self.prefix = prefix
+        self.rng = random.Random(seed)
+        self.factory = RequestFactory()
+        self.root = Page.objects.get(reverse_id=root_reverse_id(prefix))
+        self.pages = list(Page.objects.filter(tree_id=self.root.tree_id))
+        self.users = list(User.objects.filter(username__startswith='%s-user-' % prefix).order_by('pk'))
+        self.questions = dict((q.slug, q) for q in Question.objects.filter(slug__startswith='%s-p' % prefix))
+        self.scoring = SectionedScoring.objects.get(placeholder__page=self.root)
+        self.progress = ProgressBar.objects.filter(placeholder__page=self.root)[0]
+        self.formnav = FormNav.objects.filter(placeholder__page=self.root)[0]
+        self.bulk_answer = BulkAnswer.objects.filter(placeholder__page=self.root)[0]
+        self.tags = list(self.scoring.sections.values_list('tag', flat=True))
+        page_slugs = set(Question.all_in_page(self.root).values_list('slug', flat=True))
+        self.page_questions = [q for slug, q in sorted(self.questions.items()) if slug in page_slugs]
+
+    def all(self):
+        """Return ``[(name, func), ...]`` for every case."""
+        cases = [
+            ('submit', self.submit),
+            ('scores', self.scores),
+            ('render:SectionedScoringPlugin', self.render_plugin('SectionedScoringPlugin', self.scoring)),
+            ('render:ProgressBarPlugin', self.render_plugin('ProgressBarPlugin', self.progress)),
+            ('render:FormNavPlugin', self.render_plugin('FormNavPlugin', self.formnav)),
+            ('render:BulkAnswerPlugin', self.render_plugin('BulkAnswerPlugin', self.bulk_answer)),
+            ('render:page_questions', self.render_page_questions),
+            ('tags:saq_percent_score', self.render_tag('saq_percent_score', self.page_questions[0].slug)),
+            ('tags:saq_raw_answer', self.render_tag('saq_raw_answer', self.page_questions[0].slug)),
+            ('tags:saq_nice_answer', self.render_tag('saq_nice_answer', self.page_questions[0].slug)),
+            ('tags:saq_aggregate_percent_score_by_tags', self.render_tag(
+                'saq_aggregate_percent_score_by_tags', ','.join(self.tags[:2]))),
+            ('aggregate_score_for_user_by_tags', self.aggregate_for_user),
+            ('aggregate_scores_for_users_by_tags', self.aggregate_for_users),
+            ('SectionedScoring.scores_for_user', lambda: self.scoring.scores_for_user(self.user())),
+            ('ProgressBar.progress_for_user', lambda: self.progress.progress_for_user(self.user())),
+        ]
+        if CohortScores is not None:
+            cases.append(('CohortScores.section_scores', self.cohort_section_scores))
+        # one question rendered by each question plugin
+        questions = {}
+        for question in self.page_questions:
+            questions.setdefault(question.get_plugin_class().__name__, question)
+        for plugin, question in sorted(questions.items()):
+            cases.append(('render:%s' % plugin, self.render_plugin(plugin, question)))
+        return cases
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def request(self, method='get', path='/', data=None):
+        request = getattr(self.factory, method)(path, data or {})
+        request.user = self.user()
+        request.current_page = self.root
+        return request
+
+    def submit(self):
+        data = {}
+        for question in self.page_questions:
+            entry = catalog.get(question.slug)
+            if question.question_type == 'F':
+                data[question.slug] = 'Some free text'
+            else:
+                data[question.slug] = self.rng.choice(entry.scores.keys())
+        response = views._submit(self.request('post', data=data))
+        assert response.status_code == 200, response.content
+
+    def scores(self):
+        slugs = [q.slug for q in self.page_questions]
+        response = views.scores(self.request(data={'q': slugs}))
+        assert response.status_code == 200, response.content
+
+    def render_plugin(self, name, instance):
+        def render():
+            plugin = instance.get_plugin_class()()
+            plugin.render(RequestContext(self.request()), instance, instance.placeholder)
+        return render
+
+    def render_page_questions(self):
+        request = self.request()
+        for question in self.page_questions:
+            plugin = question.get_plugin_class()()
+            plugin.render(RequestContext(request), question, question.placeholder)
+
+    def render_tag(self, tag, argument):
+        template = Template('{%% load saq_tags %%}{%% %s "%s" %%}' % (tag, argument))
+        return lambda: template.render(RequestContext(self.request()))
+
+    def aggregate_for_user(self):
+        aggregate_score_for_user_by_tags(self.user(), self.tags[:2])
+
+    def aggregate_for_users(self):
+        aggregate_scores_for_users_by_tags(self.users, self.tags[:2])
+
+    def cohort_section_scores(self):
+        CohortScores(self.users).section_scores(self.scoring)
+
+    def summary(self):
+        return {
+            'pages': len(self.pages),
+            'questions': len(self.questions),
+            'users': len(self.users),
+            # the generator creates its users in one run, so their ids are contiguous
+            'submissions': sum([Submission.objects.using(alias).filter(
+                user__gte=self.users[0].pk, user__lte=self.users[-1].pk).count()
+                for alias in shards()]) if self.users else 0,
+        }
@@ -0,0 +1,104 @@
+"""Synthetic questionnaire data for the benchmarks."""
+import random
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from cms_saq.models import Answer, GroupedAnswer, Submission, ScoreSection
+
+# (slug code, question type, plugin)
+QUESTION_PLUGINS = (
+    ('s', 'S', 'SingleChoiceQuestionPlugin'),
+    ('d', 'S', 'DropDownQuestionPlugin'),
+    ('g', 'S', 'GroupedDropDownQuestionPlugin'),
+    ('m', 'M', 'MultiChoiceQuestionPlugin'),
+    ('f', 'F', 'FreeTextQuestionPlugin'),
+)
+
+
+def root_reverse_id(prefix):
+    return '%s-root' % prefix
+
+
+def generate(prefix='bench', pages=10, questions=5, answers=4, tags=5,
+             users=100, density=0.8, seed=0, log=None):
+    """Build a page tree of ``pages`` pages under one root, each holding
+    ``questions`` questions of every plugin type with ``answers`` answers
+    (in two groups, for grouped drop-downs), tagged round-robin with ``tags``
+    tags.  The root also gets a Sectioned Scoring plugin with a section per
+    tag, and every page a Progress Bar, Back / Next buttons and a Bulk
+    Answer.  Then ``users`` users answer each question with
+    probability ``density``.  Returns the root page."""
+    # cms.api loads the plugin pool, which queries pages on import
+    from cms.api import create_page, add_plugin
+    from cms.utils.i18n import get_default_language
+    from cms.utils.plugins import get_placeholders
+
+    rng = random.Random(seed)
+    template = settings.CMS_TEMPLATES[0][0]
+    language = get_default_language()
+    tag_names = ['%s-tag-%d' % (prefix, i) for i in range(tags)]
+
+    def placeholder(page):
+        slot = get_placeholders(page.get_template())[0]
+        return page.placeholders.get_or_create(slot=slot)[0]
+
+    root = create_page('%s root' % prefix, template, language,
+            reverse_id=root_reverse_id(prefix), slug=prefix)
+    scoring = add_plugin(placeholder(root), 'SectionedScoringPlugin', language)
+    for i, tag in enumerate(tag_names):
+        ScoreSection.objects.create(group=scoring, label=tag, tag=tag, order=i)
+
+    choice_questions = []
+    free_questions = []
+    n = 0
+    for p in range(pages):
+        page = root if p == 0 else create_page('%s page %d' % (prefix, p), template,
+                language, parent=root, slug='%s-%d' % (prefix, p))
+        for j in range(questions):
+            for code, question_type, plugin_type in QUESTION_PLUGINS:
+                slug = '%s-p%d-%s%d' % (prefix, p, code, j)
+                question = add_plugin(placeholder(page), plugin_type, language,
+                        slug=slug, label=slug, question_type=question_type)
+                if question_type == 'F':
+                    free_questions.append(question)
+                    continue
+                for k in range(answers):
+                    if code == 'g':
+                        GroupedAnswer.objects.create(question=question, slug='a%d' % k,
+                                title='Answer %d' % k, score=k * 10, order=k,
+                                group='Group %d' % (k * 2 / answers))
+                    else:
+                        Answer.objects.create(question=question, slug='a%d' % k,
+                                title='Answer %d' % k, score=k * 10, order=k)
+                question.tags.add(tag_names[n % tags])
+                n += 1
+                choice_questions.append(question)
+        add_plugin(placeholder(page), 'ProgressBarPlugin', language)
+        add_plugin(placeholder(page), 'FormNavPlugin', language)
+        add_plugin(placeholder(page), 'BulkAnswerPlugin', language,
+                answer_value='a0', label='Answer all with answer 0')
+        if log:
+            log("Created page %d of %d\n" % (p + 1, pages))
+
+    for u in range(users):
+        user = User.objects.create(username='%s-user-%d' % (prefix, u))
+        submissions = []
+        for question in choice_questions:
+            if rng.random() < density:
+                if question.question_type == 'S':
+                    answer = 'a%d' % rng.randrange(answers)
+                else:
+                    picked = rng.sample(range(answers), rng.randint(1, answers))
+                    answer = ','.join(['a%d' % k for k in sorted(picked)])
+                score = sum([int(a[1:]) * 10 for a in answer.split(',')])
+                submissions.append(Submission(user=user, question=question.slug,
+                        answer=answer, score=score))
+        for question in free_questions:
+            if rng.random() < density:
+                submissions.append(Submission(user=user, question=question.slug,
+                        answer='Some free text', score=0))
+        Submission.objects.save_batch(user, submissions)
+        if log and (u + 1) % 100 == 0:
+            log("Created %d of %d users\n" % (u + 1, users))
+    return root
@@ -0,0 +1,362 @@
+"""
+Cached, compiled views of the questions, kept out of the hot paths' queries.
+
+The catalog is a process-wide map from question slug to its answer scores,
+max score, optional flag and tags, used for scoring and validation.  It is
+built lazily in three queries and thrown away whenever a question, answer or
+tag is saved or deleted.
+
+The tag index maps each tag to the questions carrying it, for tag-based
+scoring.  It is derived from the catalog, and kept both in process and in
+the Django cache.
+
+The tree index maps each CMS page tree to the questions placed on its pages,
+and lives in the Django cache.
+
+All three are invalidated by bumping a generation counter kept in the Django
+cache, which also tells other processes that their copies are stale.  So the
+cache has to be shared by every process serving requests: the local-memory
+and dummy backends are refused unless ``SAQ_ALLOW_LOCAL_CACHE`` says there is
+only one such process.
+
+The submission cache keeps each user's answers and scores in the Django
+cache too, keyed by a per-user counter that is bumped on submit, and needs
+the same shared cache.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+# cache backends of which each process has its own copy
+LOCAL_CACHES = ('LocMemCache', 'DummyCache')
+
+
+def check_shared_cache():
+    """Raise ImproperlyConfigured if the Django cache isn't shared between
+    processes, and ``SAQ_ALLOW_LOCAL_CACHE`` isn't set."""
+    if (type(cache).__name__ in LOCAL_CACHES
+            and not getattr(settings, 'SAQ_ALLOW_LOCAL_CACHE', False)):
+        raise ImproperlyConfigured(
+                "cms_saq needs a cache shared by all processes, not %s; set "
+                "SAQ_ALLOW_LOCAL_CACHE = True if only one process serves "
+                "requests." % type(cache).__name__)
+
+
+class Generation(object):
+    """A counter in the Django cache, bumped to invalidate cached data."""
+
+    def __init__(self, key):
+        self.key = key
+
+    def current(self):
+        check_shared_cache()
+        generation = cache.get(self.key)
+        if generation is None:
+            # Seed with a timestamp rather than 1 so that a counter evicted
+            # from the cache never comes back with a value a process has
+            # already seen.
+            cache.add(self.key, int(time.time() * 1000), GENERATION_TIMEOUT)
+            generation = cache.get(self.key)
+        return generation
+
+    def bump(self):
+        try:
+            cache.incr(self.key)
+        except ValueError:
+            cache.set(self.key, int(time.time() * 1000), GENERATION_TIMEOUT)
+
+
+class CatalogEntry(object):
+    """Everything needed to validate and score answers to one question."""
+
+    def __init__(self, pk, slug, question_type, label, optional):
+        self.pk = pk
+        self.slug = slug
+        self.question_type = question_type
+        self.label = label
+        self.optional = optional
+        self.scores = {}
+        self.titles = {}
+        self.answer_ids = {}
+        self.tags = frozenset()
+        self.max_score = None
+
+    def finalize(self):
+        if self.scores:
+            if self.question_type == 'S':
+                self.max_score = max(self.scores.values())
+            elif self.question_type == 'M':
+                self.max_score = sum(self.scores.values())
+
+    def score(self, answers):
+        """Score an answer string, raising ``Answer.DoesNotExist`` for any
+        answer slug that doesn't belong to this question."""
+        if self.question_type == 'F':
+            return 0
+        try:
+            if self.question_type == 'S':
+                return self.scores[answers]
+            elif self.question_type == 'M':
+                return sum([self.scores[a] for a in answers.split(',')])
+        except KeyError, e:
+            from cms_saq.models import Answer
+            raise Answer.DoesNotExist("Invalid answer '%s' to %s" % (e.args[0], self.slug))
+
+    def choice_ids(self, answers):
+        """The ids of the answers chosen in an answer string, skipping any
+        that don't belong to this question; free text has no choices."""
+        if self.question_type == 'F' or not answers:
+            return []
+        return [self.answer_ids[a] for a in answers.split(',') if a in self.answer_ids]
+
+    def percent_score(self, score):
+        """Express a raw score as a percentage of the maximum, or None for
+        unscored questions."""
+        if self.max_score:
+            return 100.0 * score / self.max_score
+        return None
+
+
+class Catalog(object):
+
+    def __init__(self):
+        self._entries = None
+        self._generation = None
+        self._lock = threading.Lock()
+        self.generation = Generation('cms_saq:catalog:generation')
+
+    def entries(self):
+        """Return the current ``{slug: CatalogEntry}`` map, rebuilding it
+        first if it is missing or stale."""
+        generation = self.generation.current()
+        entries = self._entries
+        if entries is None or generation != self._generation:
+            entries = self._rebuild(generation)
+        return entries
+
+    def get(self, slug):
+        return self.entries().get(slug)
+
+    def reload(self):
+        """Rebuild this process's copy now, whatever the generation says,
+        for when it may have missed a change."""
+        return self._rebuild(self.generation.current())
+
+    def invalidate(self, **kwargs):
+        """Drop this process's copy and bump the shared generation.  Accepts
+        arbitrary keyword arguments so it can be connected to signals."""
+        self._entries = None
+        self.generation.bump()
+
+    def _rebuild(self, generation):
+        self._lock.acquire()
+        try:
+            entries = self._build()
+            self._entries, self._generation = entries, generation
+        finally:
+            self._lock.release()
+        return entries
+
+    def _build(self):
+        from django.contrib.contenttypes.models import ContentType
+        from cms_saq.models import Question, Answer
+
+        entries = {}
+        by_pk = {}
+        questions = Question.objects.values_list(
+                'pk', 'slug', 'question_type', 'label', 'optional')
+        for pk, slug, question_type, label, optional in questions:
+            entry = CatalogEntry(pk, slug, question_type, label, optional)
+            entries[slug] = by_pk[pk] = entry
+
+        answers = Answer.objects.values_list('pk', 'question', 'slug', 'title', 'score')
+        for pk, question_id, slug, title, score in answers:
+            entry = by_pk.get(question_id)
+            if entry is not None:
+                entry.scores[slug] = score
+                entry.titles[slug] = title
+                entry.answer_ids[slug] = pk
+
+        through = Question._meta.get_field('tags').through
+        tags = {}
+        tagged = through.objects.filter(
+                content_type=ContentType.objects.get_for_model(Question))
+        for object_id, name in tagged.values_list('object_id', 'tag__name'):
+            tags.setdefault(object_id, set()).add(name)
+
+        for pk, entry in by_pk.items():
+            entry.tags = frozenset(tags.get(pk, ()))
+            entry.finalize()
+        return entries
+
+
+class TagIndex(object):
+    """Map from tag name to the frozen set of ``(question_pk, slug, max_score)``
+    for each question carrying it.  Shares the catalog's generation, so it is
+    rebuilt whenever a question, answer or tag changes."""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._index = None
+        self._generation = None
+
+    def index(self):
+        """Return the current ``{tag: frozenset}`` map, from this process, the
+        Django cache or, failing both, the catalog."""
+        generation = self.catalog.generation.current()
+        index = self._index
+        if index is None or generation != self._generation:
+            key = 'cms_saq:tags:%s' % generation
+            index = cache.get(key)
+            if index is None:
+                index = {}
+                for entry in self.catalog.entries().values():
+                    for tag in entry.tags:
+                        index.setdefault(tag, set()).add((entry.pk, entry.slug, entry.max_score))
+                index = dict((tag, frozenset(questions)) for tag, questions in index.items())
+                cache.set(key, index, GENERATION_TIMEOUT)
+            self._index, self._generation = index, generation
+        return index
+
+    def questions(self, tags):
+        """``(question_pk, slug, max_score)`` for each question carrying any
+        of ``tags``."""
+        index = self.index()
+        return frozenset().union(*[index.get(tag, ()) for tag in set(tags)])
+
+    def scored(self, tags):
+        """``{question_pk: max_score}`` for each scored question carrying any
+        of ``tags``."""
+        return dict((pk, max_score) for pk, slug, max_score in self.questions(tags)
+                    if max_score)
+
+    def overlap(self, tags):
+        """Whether any scored question carries more than one of ``tags``."""
+        index = self.index()
+        counted = sum([len([q for q in index.get(tag, ()) if q[2]]) for tag in set(tags)])
+        return counted != len(self.scored(tags))
+
+
+class TreeIndex(object):
+    """Map from page tree to ``(slug, optional)`` for each question in it."""
+
+    def __init__(self):
+        self.generation = Generation('cms_saq:tree:generation')
+
+    def tree(self, tree_id):
+        """Return ``{page_id: [(slug, optional), ...]}`` for the pages of the
+        tree with ``tree_id``, loading it in one query on a cache miss."""
+        key = 'cms_saq:tree:%s:%s' % (self.generation.current(), tree_id)
+        pages = cache.get(key)
+        if pages is None:
+            from cms_saq.models import Question
+            pages = {}
+            questions = Question.objects.filter(placeholder__page__tree_id=tree_id)
+            for page_id, slug, optional in questions.values_list(
+                    'placeholder__page', 'slug', 'optional'):
+                pages.setdefault(page_id, []).append((slug, optional))
+            cache.set(key, pages, GENERATION_TIMEOUT)
+        return pages
+
+    def trees_by_question(self):
+        """Return ``{slug: [tree_id, ...]}`` for every question on a page."""
+        key = 'cms_saq:tree:%s:by-question' % self.generation.current()
+        trees = cache.get(key)
+        if trees is None:
+            from cms_saq.models import Question
+            trees = {}
+            questions = Question.objects.filter(placeholder__page__isnull=False)
+            for slug, tree_id in questions.values_list('slug', 'placeholder__page__tree_id'):
+                trees.setdefault(slug, set()).add(tree_id)
+            trees = dict((slug, sorted(ids)) for slug, ids in trees.items())
+            cache.set(key, trees, GENERATION_TIMEOUT)
+        return trees
+
+    def questions_in_tree(self, page):
+        questions = []
+        for page_questions in self.tree(page.tree_id).values():
+            questions.extend(page_questions)
+        return questions
+
+    def questions_in_page(self, page):
+        return self.tree(page.tree_id).get(page.pk, [])
+
+    def invalidate(self, **kwargs):
+        self.generation.bump()
+
+
+class SubmissionCache(object):
+    """Map from question slug to ``(answer, score)`` for each user's
+    submissions, loaded in one query on a miss.  Each user's map is keyed by
+    a counter that is bumped whenever their submissions change, so a map
+    read from the database before a change is never served after it.  Bump
+    ``version`` whenever what is cached changes shape; bulk changes to
+    submissions bump the generation instead.
+
+    Every process must see the counters bumped by the others, so like the
+    catalog this refuses to run on a per-process cache
+    (``check_shared_cache``)."""
+
+    version = 1
+
+    def __init__(self):
+        self.generation = Generation('cms_saq:submissions:generation')
+
+    def _user_generation(self, user_id):
+        return Generation('cms_saq:submissions:%s:%s:%s:modified' % (
+                self.version, self.generation.current(), user_id))
+
+    def _key(self, user_id):
+        modified = self._user_generation(user_id)
+        return '%s:%s' % (modified.key, modified.current())
+
+    def _timeout(self):
+        return getattr(settings, 'SAQ_SUBMISSION_CACHE_TIMEOUT', 60 * 60 * 24)
+
+    def get(self, user, using=None):
+        """Return ``{slug: (answer, score)}`` for ``user`` (a user or user
+        id), reading a miss from ``using`` or the user's shard.  What is read
+        from a replica isn't cached: it may be from before a submit that has
+        already bumped the user's counter."""
+        from cms_saq.models import Submission
+        from cms_saq.routers import replicas, shard_for_user
+
+        user_id = getattr(user, 'pk', user)
+        if user_id is None:
+            return {}
+        key = self._key(user_id)
+        submissions = cache.get(key)
+        if submissions is None:
+            using = using or shard_for_user(user_id)
+            rows = Submission.objects.using(using).filter(
+                    user=user_id).values_list('question', 'answer', 'score')
+            submissions = dict((slug, (answer, score)) for slug, answer, score in rows)
+            if using not in replicas().values():
+                cache.set(key, submissions, self._timeout())
+        return submissions
+
+    def invalidate_user(self, user):
+        """Record that ``user``'s submissions have just changed, once the
+        change is committed; their next read loads them afresh."""
+        self._user_generation(getattr(user, 'pk', user)).bump()
+
+    def modified(self, user):
+        """A number that goes up with every change to ``user``'s
+        submissions: roughly when they last changed, in milliseconds since
+        the epoch, since it starts from the time it was first read (or lost
+        from the cache) and counts up from there."""
+        return self._user_generation(getattr(user, 'pk', user)).current()
+
+    def invalidate(self, **kwargs):
+        self.generation.bump()
+
+
+catalog = Catalog()
+tag_index = TagIndex(catalog)
+tree_index = TreeIndex()
+submission_cache = SubmissionCache()
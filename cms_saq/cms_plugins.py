@@ -5,8 +5,11 @@ from django.contrib import admin
 from cms.plugin_base import CMSPluginBase
 from cms.plugin_pool import plugin_pool
 
-from cms_saq.models import Question, Answer, GroupedAnswer, Submission, \
-        FormNav, ProgressBar, SectionedScoring, ScoreSection, BulkAnswer
+from cms_saq.loader import get_loader
+from cms_saq.routers import read_database, shard_for_user
+from cms_saq.models import Question, Answer, GroupedAnswer, \
+        FormNav, ProgressBar, SectionedScoring, ScoreSection, BulkAnswer, \
+        ScoreDistribution
 
 class AnswerAdmin(admin.StackedInline):
     model = Answer
@@ -27,16 +30,14 @@ class QuestionPlugin(CMSPluginBase):
     exclude = ('question_type',)
 
     def render(self, context, instance, placeholder):
-        user = context['request'].user
+        loader = get_loader(context['request'])
         extra = {
             'question': instance,
-            'answers': instance.answers.all()
+            'answers': loader.answers(instance)
         }
-        if user.is_authenticated():
-            try:
-                extra['submission'] = Submission.objects.get(user=user, question=instance.slug)
-            except Submission.DoesNotExist:
-                pass
+        submission = loader.submission(instance.slug)
+        if submission is not None:
+            extra['submission'] = submission
         context.update(extra)
         return context
 
@@ -70,7 +71,7 @@ class GroupedDropDownQuestionPlugin(QuestionPlugin):
 
     def render(self, context, instance, placeholder):
         new_ctx = super(GroupedDropDownQuestionPlugin, self).render(context, instance, placeholder)
-        answers = list(GroupedAnswer.objects.filter(question=instance))
+        answers = get_loader(context['request']).grouped_answers(instance)
         grouped_answers = itertools.groupby(answers, operator.attrgetter('group'))
         grouped_answers = [[key, list(group)] for key, group in grouped_answers]
         new_ctx.update({'grouped_answers': grouped_answers})
@@ -92,9 +93,8 @@ class FormNavPlugin(CMSPluginBase):
         met_end_condition = False
         if instance.end_page_condition_question:
             end_condition_slug = instance.end_page_condition_question.slug
-            met_end_condition = (Submission.objects
-                .filter(user=context['user'], question=end_condition_slug)
-                .count()) > 0
+            loader = get_loader(context['request'])
+            met_end_condition = loader.submission(end_condition_slug) is not None
         context.update({
             'instance': instance,
             'met_end_condition': met_end_condition
@@ -114,10 +114,24 @@ class SectionedScoringPlugin(CMSPluginBase):
     inlines = [ScoreSectionAdmin]
 
     def render(self, context, instance, placeholder):
-        scores, overall = instance.scores_for_user(context['request'].user)
+        request = context['request']
+        using = read_database(request, shard_for_user(request.user))
+        scores, overall = instance.scores_for_user(request.user, using)
+        sections = [(label, score, None) for label, score in scores]
+        overall_percentile = None
+        if instance.show_percentiles:
+            # one indexed lookup per score, in the default database
+            using = read_database(request)
+            percentile = ScoreDistribution.objects.percentile
+            sections = [(label, score, percentile(ScoreDistribution.TAG, section.tag, score, using))
+                        for section, (label, score) in zip(instance.sections.all(), scores)]
+            overall_percentile = percentile(ScoreDistribution.SCORING, str(instance.pk),
+                                            overall, using)
         context.update({
             'scores': scores,
-            'overall': overall
+            'overall': overall,
+            'sections': sections,
+            'overall_percentile': overall_percentile,
         })
         return context
 
@@ -128,11 +142,13 @@ class ProgressBarPlugin(CMSPluginBase):
     render_template = "cms_saq/progress_bar.html"
 
     def render(self, context, instance, placeholder):
-        answered, total = instance.progress_for_user(context['request'].user)
+        request = context['request']
+        using = read_database(request, shard_for_user(request.user))
+        answered, total = instance.progress_for_user(request.user, using)
         context.update({
             'answered': answered,
             'total': total,
-            'progress': float(answered) / float(total) * 100,
+            'progress': float(answered) / float(total) * 100 if total else 0,
         })
         return context
 
@@ -0,0 +1,288 @@
+"""
+Vectorised scoring of whole cohorts of users, for reports.
+
+``CohortScores`` loads the ``(user, question, score)`` of every submission
+by a set of users, a batch of users per query, into a dense users x
+questions NumPy matrix.  Percent scores, tag aggregates and Sectioned Scoring
+results for all of the users then come out as array operations, matching
+``aggregate_score_for_user_by_tags`` and ``SectionedScoring.scores_for_user``
+up to floating-point rounding.
+
+``ScoreMatrix`` keeps a users x questions matrix of raw scores on disk, as a
+NumPy ``.npy`` file with a JSON index of its rows and columns, for reports
+to memory-map read-only from any number of processes.
+``update_score_matrix`` (and the command of the same name) brings it up to
+date with the submissions modified since it was last updated.
+
+Needs NumPy, which django-cms-saq doesn't otherwise depend on.
+"""
+import datetime
+import os
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from django.utils import simplejson
+
+from cms_saq.catalog import catalog, tag_index
+from cms_saq.models import Submission, USER_BATCH_SIZE
+from cms_saq.routers import group_by_shard, shards
+
+
+class CohortScores(object):
+    """Scores for ``users`` (instances or ids) on every scored question.
+    Rows follow ``user_ids`` and columns ``question_ids``, both ascending."""
+
+    def __init__(self, users, using=None):
+        user_ids = sorted(set([getattr(u, 'pk', u) for u in users]))
+        self._prepare(user_ids)
+        if user_ids and self.slugs:
+            self._load(user_ids, using)
+        self._finish()
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """Scores for every user in the ``ScoreMatrix`` ``matrix``, read from
+        it rather than from the database."""
+        cohort = cls.__new__(cls)
+        order = numpy.argsort(matrix.user_ids)
+        cohort._prepare(matrix.user_ids[order])
+        for i, slug in enumerate(cohort.slugs):
+            if slug in matrix.columns:
+                cohort.scores[:, i] = matrix.scores[:, matrix.columns[slug]][order]
+        # unanswered questions are NaN in the matrix
+        cohort.scores[numpy.isnan(cohort.scores)] = 0
+        cohort._finish()
+        return cohort
+
+    def _prepare(self, user_ids):
+        entries = sorted([e for e in catalog.entries().values() if e.max_score],
+                         key=lambda e: e.pk)
+        self.user_ids = numpy.array(user_ids, dtype=numpy.int64)
+        self.question_ids = numpy.array([e.pk for e in entries], dtype=numpy.int64)
+        self.slugs = [e.slug for e in entries]
+        self.max_scores = numpy.array([e.max_score for e in entries], dtype=numpy.float64)
+        self.scores = numpy.zeros((len(user_ids), len(entries)))
+
+    def _finish(self):
+        # unanswered questions score zero
+        self.percent_scores = 100.0 * self.scores / self.max_scores
+
+    def _load(self, user_ids, using):
+        if using is None:
+            by_shard = group_by_shard(user_ids).items()
+        else:
+            by_shard = [(using, user_ids)]
+        for alias, ids in by_shard:
+            submissions = Submission.objects.using(alias).filter(question_ref__isnull=False)
+            for i in range(0, len(ids), USER_BATCH_SIZE):
+                batch = submissions.filter(user__in=ids[i:i + USER_BATCH_SIZE])
+                rows = numpy.array(list(batch.values_list('user', 'question_ref', 'score')),
+                                   dtype=numpy.int64).reshape(-1, 3)
+                # drop submissions to unscored questions
+                rows = rows[numpy.in1d(rows[:, 1], self.question_ids)]
+                self.scores[numpy.searchsorted(self.user_ids, rows[:, 0]),
+                            numpy.searchsorted(self.question_ids, rows[:, 1])] = rows[:, 2]
+
+    def user_index(self, user):
+        """The row of ``user`` (an instance or id)."""
+        user_id = getattr(user, 'pk', user)
+        index = numpy.searchsorted(self.user_ids, user_id)
+        if index == len(self.user_ids) or self.user_ids[index] != user_id:
+            raise KeyError(user_id)
+        return index
+
+    def tag_scores(self, tags):
+        """Each user's average percent score over the questions tagged with
+        any of ``tags``, as ``aggregate_score_for_user_by_tags`` gives it."""
+        columns = numpy.in1d(self.question_ids, sorted(tag_index.scored(tags)))
+        if not columns.any():
+            return numpy.zeros(len(self.user_ids))
+        return self.percent_scores[:, columns].mean(axis=1)
+
+    def section_scores(self, scoring):
+        """Return ``(labels, scores, overall)`` for the ``SectionedScoring``
+        ``scoring``: its section labels, a users x sections matrix of section
+        scores and each user's overall score."""
+        sections = list(scoring.sections.all())
+        labels = [section.label for section in sections]
+        if not sections:
+            empty = numpy.zeros((len(self.user_ids), 0))
+            return labels, empty, numpy.zeros(len(self.user_ids))
+        scores = numpy.column_stack([self.tag_scores([section.tag]) for section in sections])
+        return labels, scores, scores.mean(axis=1)
+
+    def scores_for_user(self, scoring, user):
+        """``SectionedScoring.scores_for_user`` for one of the cohort, taken
+        from ``section_scores``."""
+        labels, scores, overall = self.section_scores(scoring)
+        index = self.user_index(user)
+        return [[[label, float(score)] for label, score in zip(labels, scores[index])],
+                float(overall[index])]
+
+
+# the matrix's initial room for users and questions, grown by doubling
+MATRIX_ROWS = 1024
+MATRIX_COLUMNS = 64
+
+WATERMARK_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def _parse_watermark(value):
+    for format in WATERMARK_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Can't parse watermark '%s'" % value)
+
+
+class ScoreMatrix(object):
+    """A users x questions matrix of raw scores, memory-mapped from
+    ``scores.npy`` in the directory ``path``, with unanswered questions NaN.
+    ``index.json`` lists the users (rows) and question slugs (columns) in
+    the order they were added, and the ``watermark``: the latest
+    modification time of the submissions applied.
+
+    Rows and columns are only ever added, and the index is written after
+    the matrix, so a reader always finds every row and column of its index
+    in the matrix it maps."""
+
+    matrix_name = 'scores.npy'
+    index_name = 'index.json'
+
+    def __init__(self, path, index, scores):
+        self.path = path
+        self.user_ids = numpy.array(index['user_ids'], dtype=numpy.int64)
+        self.slugs = list(index['slugs'])
+        self.watermark = index['watermark'] and _parse_watermark(index['watermark'])
+        self.rows = dict((user_id, i) for i, user_id in enumerate(index['user_ids']))
+        self.columns = dict((slug, i) for i, slug in enumerate(self.slugs))
+        self._matrix = scores
+        self.scores = scores[:len(self.user_ids), :len(self.slugs)]
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """Map the matrix at ``path``, read-only unless ``mode`` is 'r+'."""
+        index = simplejson.load(open(os.path.join(path, cls.index_name)))
+        scores = numpy.load(os.path.join(path, cls.matrix_name), mmap_mode=mode)
+        return cls(path, index, scores)
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, cls.index_name))
+
+    def row(self, user):
+        """The scores of ``user`` (an instance or id), by column."""
+        return self.scores[self.rows[getattr(user, 'pk', user)]]
+
+    def column(self, slug):
+        """The scores for the question ``slug``, by row."""
+        return self.scores[:, self.columns[slug]]
+
+
+def _replace(path, write):
+    """Write a file through ``write(filename)`` then move it into place, so
+    that readers see either the old file or the new one, complete."""
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    write(temporary)
+    os.rename(temporary, path)
+
+
+class _Updater(object):
+    """Grows and fills a ``ScoreMatrix``'s files in place."""
+
+    def __init__(self, path, rebuild):
+        self.path = path
+        if ScoreMatrix.exists(path) and not rebuild:
+            matrix = ScoreMatrix.open(path, mode='r+')
+            self.user_ids = [int(u) for u in matrix.user_ids]
+            self.slugs = matrix.slugs
+            self.watermark = matrix.watermark
+            self.matrix = matrix._matrix
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.user_ids, self.slugs, self.watermark = [], [], None
+            self.matrix = self._allocate(MATRIX_ROWS, MATRIX_COLUMNS)
+        self.rows = dict((user_id, i) for i, user_id in enumerate(self.user_ids))
+        self.columns = dict((slug, i) for i, slug in enumerate(self.slugs))
+
+    def _allocate(self, rows, columns, old=None):
+        def write(filename):
+            matrix = open_memmap(filename, mode='w+', dtype=numpy.float64, shape=(rows, columns))
+            matrix[:] = numpy.nan
+            if old is not None:
+                matrix[:old.shape[0], :old.shape[1]] = old
+            matrix.flush()
+            del matrix
+        _replace(os.path.join(self.path, ScoreMatrix.matrix_name), write)
+        return numpy.load(os.path.join(self.path, ScoreMatrix.matrix_name), mmap_mode='r+')
+
+    def _index(self, key, index, keys):
+        if key not in index:
+            index[key] = len(keys)
+            keys.append(key)
+        return index[key]
+
+    def apply(self, rows):
+        """Write ``(user_id, slug, score)`` rows into the matrix."""
+        rows = [(self._index(user_id, self.rows, self.user_ids),
+                 self._index(slug, self.columns, self.slugs), score)
+                for user_id, slug, score in rows]
+        height, width = self.matrix.shape
+        if len(self.user_ids) > height or len(self.slugs) > width:
+            while height < len(self.user_ids):
+                height *= 2
+            while width < len(self.slugs):
+                width *= 2
+            self.matrix.flush()
+            self.matrix = self._allocate(height, width, self.matrix)
+        if rows:
+            rows = numpy.array(rows, dtype=numpy.float64)
+            self.matrix[rows[:, 0].astype(numpy.int64), rows[:, 1].astype(numpy.int64)] = rows[:, 2]
+
+    def save(self, watermark):
+        self.matrix.flush()
+        index = {
+            'user_ids': self.user_ids,
+            'slugs': self.slugs,
+            'watermark': watermark and watermark.strftime(WATERMARK_FORMATS[0]),
+        }
+        def write(filename):
+            f = open(filename, 'w')
+            simplejson.dump(index, f)
+            f.close()
+        _replace(os.path.join(self.path, ScoreMatrix.index_name), write)
+
+
+def update_score_matrix(path, rebuild=False, overlap=300, chunk_size=2000):
+    """Apply every submission modified since the watermark of the matrix at
+    ``path`` (less ``overlap`` seconds, for transactions that committed
+    after later ones) to it, creating it, or with ``rebuild`` recreating it,
+    from all submissions.  Returns ``(applied, matrix)``.
+
+    Deleted submissions, and questions' slugs changing, are only caught up
+    with by a rebuild."""
+    updater = _Updater(path, rebuild)
+    watermark = updater.watermark
+    applied = 0
+    for alias in shards():
+        submissions = Submission.objects.using(alias).order_by('pk')
+        if updater.watermark is not None:
+            submissions = submissions.filter(modified__gte=updater.watermark -
+                    datetime.timedelta(seconds=overlap))
+        last = 0
+        while True:
+            chunk = list(submissions.filter(pk__gt=last).values_list(
+                    'pk', 'user', 'question', 'score', 'modified')[:chunk_size])
+            if not chunk:
+                break
+            updater.apply([(user_id, slug, score) for pk, user_id, slug, score, modified in chunk])
+            newest = max([row[4] for row in chunk])
+            if watermark is None or newest > watermark:
+                watermark = newest
+            applied += len(chunk)
+            last = chunk[-1][0]
+    updater.save(watermark)
+    return applied, ScoreMatrix.open(path)
@@ -0,0 +1,81 @@
+"""
+Request-scoped loading of the data SAQ plugins and template tags render.
+
+The first plugin or tag to ask for a submission reads all of the user's
+submissions from the submission cache (one query on a miss), and the first
+to ask for answers fetches the answers to every question on the current page
+in one query; the rest of the page reads from the same loader.  Answers to
+questions that aren't on the current page are fetched (and remembered) one
+question at a time.  Reads go to a replica when one is configured (see
+``cms_saq.routers.read_database``).
+"""
+from cms_saq.catalog import catalog, submission_cache, tree_index
+from cms_saq.models import Answer, GroupedAnswer, Submission
+from cms_saq.routers import read_database, shard_for_user
+
+
+def get_loader(request):
+    """Return the loader attached to ``request``, creating it if needed."""
+    loader = getattr(request, '_saq_loader', None)
+    if loader is None:
+        loader = request._saq_loader = SubmissionLoader(request)
+    return loader
+
+
+class SubmissionLoader(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.user = getattr(request, 'user', None)
+        self.using = read_database(request, shard_for_user(self.user))
+        self.answers_using = read_database(request)
+        self._submissions = None
+        self._answers = None
+        self._grouped_answers = None
+
+    def _page_question_ids(self):
+        page = getattr(self.request, 'current_page', None)
+        if not page:
+            return {}
+        entries = catalog.entries()
+        slugs = [slug for slug, optional in tree_index.questions_in_page(page)]
+        return dict((slug, entries[slug].pk) for slug in slugs if slug in entries)
+
+    def submission(self, question_slug):
+        """The user's submission for ``question_slug``, or None.  Built from
+        the submission cache, so it is unsaved."""
+        if self._submissions is None:
+            cached = {}
+            if self.user is not None and self.user.is_authenticated():
+                cached = submission_cache.get(self.user, self.using)
+            self._submissions = dict(
+                    (slug, Submission(user=self.user, question=slug, answer=answer, score=score))
+                    for slug, (answer, score) in cached.items())
+        return self._submissions.get(question_slug)
+
+    def answers(self, question):
+        """The answers to ``question``, in their usual order."""
+        if self._answers is None:
+            self._answers = self._load_answers(Answer)
+        if question.pk not in self._answers:
+            self._answers[question.pk] = list(
+                    Answer.objects.using(self.answers_using).filter(question=question))
+        return self._answers[question.pk]
+
+    def grouped_answers(self, question):
+        """The grouped answers to ``question``."""
+        if self._grouped_answers is None:
+            self._grouped_answers = self._load_answers(GroupedAnswer)
+        if question.pk not in self._grouped_answers:
+            self._grouped_answers[question.pk] = list(
+                    GroupedAnswer.objects.using(self.answers_using).filter(question=question))
+        return self._grouped_answers[question.pk]
+
+    def _load_answers(self, model):
+        question_ids = self._page_question_ids().values()
+        answers = dict((pk, []) for pk in question_ids)
+        if question_ids:
+            answers_in = model.objects.using(self.answers_using).filter(question__in=question_ids)
+            for answer in answers_in:
+                answers[answer.question_id].append(answer)
+        return answers
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from cms_saq.models import Submission, SubmissionChoice
+from cms_saq.routers import shards
+
+class Command(BaseCommand):
+    help = "Records the chosen answers of existing django-cms-saq submissions."
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help="Number of submissions to backfill per transaction (default 500)."),
+    )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        backfilled = 0
+        for alias in shards():
+            submissions = Submission.objects.using(alias).order_by('pk').values_list(
+                    'pk', 'question', 'answer')
+            last = 0
+            while True:
+                chunk = list(submissions.filter(pk__gt=last)[:chunk_size])
+                if not chunk:
+                    break
+                SubmissionChoice.objects.rebuild(chunk, using=alias)
+                last = chunk[-1][0]
+                backfilled += len(chunk)
+                self.stdout.write("Backfilled choices for %d submissions\n" % backfilled)
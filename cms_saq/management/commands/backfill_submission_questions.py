@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from cms_saq.catalog import catalog
+from cms_saq.models import Submission
+from cms_saq.routers import shards
+
+class Command(BaseCommand):
+    help = "Links existing django-cms-saq submissions to their questions by id."
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help="Number of submissions to link per transaction (default 500)."),
+    )
+
+    def handle(self, *args, **options):
+        """Fill in ``question_ref`` a chunk at a time, in short transactions,
+        so it can run while the site is up.  Submissions to questions that no
+        longer exist are left unlinked."""
+        chunk_size = options['chunk_size']
+        entries = catalog.entries()
+        linked, orphaned = 0, 0
+        for alias in shards():
+            submissions = Submission.objects.using(alias).filter(
+                    question_ref__isnull=True).order_by('pk')
+            last = 0
+            while True:
+                chunk = list(submissions.filter(pk__gt=last).values_list(
+                        'pk', 'question')[:chunk_size])
+                if not chunk:
+                    break
+                last = chunk[-1][0]
+                by_question = {}
+                for pk, question in chunk:
+                    if question in entries:
+                        by_question.setdefault(entries[question].pk, []).append(pk)
+                    else:
+                        orphaned += 1
+                with transaction.commit_on_success(using=alias):
+                    for question_id, pks in by_question.items():
+                        # re-check question_ref so rows saved meanwhile are left alone
+                        linked += submissions.filter(pk__in=pks).update(
+                                question_ref=question_id)
+                self.stdout.write("Linked %d submissions, %d without a question\n" % (
+                        linked, orphaned))
@@ -1,13 +1,100 @@
-from django.core.management.base import BaseCommand
+from itertools import groupby
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
 from django.utils import simplejson
+
+from cms.models import Page
+from cms_saq.catalog import tree_index
 from cms_saq.models import Question
 
+
 class Command(BaseCommand):
     help = "Dumps django-cms-saq question tags."
+    option_list = BaseCommand.option_list + (
+        make_option('--page', dest='page', type='int', default=None,
+            help="Only dump questions in the page tree of this page id."),
+        make_option('--tag-prefix', dest='tag_prefix', default=None,
+            help="Only dump questions with a tag starting with this prefix."),
+    )
 
-    def handle(self, *args, **kwargs):
+    def handle(self, *args, **options):
+        """Write ``{slug: [tag, ...]}`` for the selected questions, as
+        ``simplejson.dumps(..., indent=2, sort_keys=True)`` would, one
+        question at a time."""
         questions = Question.objects.all()
-        ret = {}
-        for question in questions:
-            ret[question.slug] = [t.name for t in question.tags.all()]
-        self.stdout.write(simplejson.dumps(ret, indent=2, sort_keys=True))
+        if options['page']:
+            try:
+                page = Page.objects.get(pk=options['page'])
+            except Page.DoesNotExist:
+                raise CommandError("Page %s does not exist." % options['page'])
+            questions = questions.filter(slug__in=[slug for slug, optional
+                                                   in tree_index.questions_in_tree(page)])
+        if options['tag_prefix']:
+            questions = questions.filter(pk__in=Question.objects.filter(
+                    tags__name__startswith=options['tag_prefix']).values('pk'))
+
+        encoder = simplejson.JSONEncoder(indent=2, sort_keys=True)
+        first = True
+        for slug, rows in groupby(self.question_tags(questions), lambda row: row[0]):
+            tags = [name for slug, name in rows if name is not None]
+            # Strip the braces from a one-item object to leave the item.
+            item = encoder.encode({slug: tags})[2:-2]
+            self.stdout.write(("{\n" if first else encoder.item_separator + "\n") + item)
+            first = False
+        self.stdout.write("{}" if first else "\n}")
+
+    def binary(self, connection, column):
+        """``column`` compared code point by code point, as Python compares
+        strings, whatever the database's collation."""
+        if connection.vendor == 'postgresql':
+            return '%s COLLATE "C"' % column
+        if connection.vendor == 'mysql':
+            return 'BINARY %s' % column
+        # SQLite's default collation is already binary
+        return column
+
+    def question_tags(self, questions):
+        """``(slug, tag name)`` pairs for ``questions`` ordered by slug and
+        tag name as Python would sort them, from one joined query; untagged
+        questions get one pair with a tag name of None."""
+        using = router.db_for_read(Question)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        through = Question._meta.get_field('tags').through
+        tag_model = through._meta.get_field('tag').rel.to
+        subquery = questions.order_by().values('pk').query
+        subquery, params = subquery.get_compiler(using=using).as_sql()
+        sql = """
+            SELECT q.%(slug)s, t.%(tag_name)s
+            FROM %(question)s q
+            LEFT OUTER JOIN %(tagged)s ti
+                ON ti.%(object_id)s = q.%(question_pk)s AND ti.%(content_type)s = %%s
+            LEFT OUTER JOIN %(tag)s t ON t.%(tag_pk)s = ti.%(tag_fk)s
+            WHERE q.%(question_pk)s IN (%(subquery)s)
+            ORDER BY %(slug_order)s, %(tag_order)s
+        """ % {
+            'slug': qn('slug'),
+            'question': qn(Question._meta.db_table),
+            'question_pk': qn(Question._meta.pk.column),
+            'tagged': qn(through._meta.db_table),
+            'object_id': qn(through._meta.get_field('object_id').column),
+            'content_type': qn(through._meta.get_field('content_type').column),
+            'tag_fk': qn(through._meta.get_field('tag').column),
+            'tag': qn(tag_model._meta.db_table),
+            'tag_pk': qn(tag_model._meta.pk.column),
+            'tag_name': qn('name'),
+            'subquery': subquery,
+            'slug_order': self.binary(connection, 'q.%s' % qn('slug')),
+            'tag_order': self.binary(connection, 't.%s' % qn('name')),
+        }
+        cursor = connection.cursor()
+        cursor.execute(sql, [ContentType.objects.get_for_model(Question).pk] + list(params))
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield row
@@ -0,0 +1,172 @@
+import csv
+import datetime
+import gzip
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from cms.models import Page
+from cms_saq.catalog import catalog, tag_index, tree_index
+from cms_saq.models import Submission, USER_BATCH_SIZE
+from cms_saq.routers import shards
+
+COLUMNS = ('user_id', 'username', 'question', 'question_label', 'answer',
+           'answer_titles', 'score', 'modified')
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def parse_datetime(value):
+    for format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise CommandError("Can't parse '%s' as a date or date and time." % value)
+
+
+class CSVWriter(object):
+
+    def __init__(self, stream):
+        self.writer = csv.writer(stream)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, row):
+        row = dict(row, answer_titles=u"; ".join(row['answer_titles']))
+        self.writer.writerow([unicode(row[c]).encode('utf-8') for c in COLUMNS])
+
+
+class NDJSONWriter(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, row):
+        self.stream.write(simplejson.dumps(row))
+        self.stream.write("\n")
+
+
+WRITERS = {'csv': CSVWriter, 'ndjson': NDJSONWriter}
+
+
+class Command(BaseCommand):
+    help = "Streams django-cms-saq submissions out as CSV or NDJSON."
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv', choices=WRITERS.keys(),
+            help="Output format: csv (default) or ndjson."),
+        make_option('--output', dest='output', default=None,
+            help="Write to this file rather than stdout."),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+            help="Gzip the output."),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=2000,
+            help="Submissions fetched per query (default 2000)."),
+        make_option('--tags', dest='tags', default=None,
+            help="Comma-separated tags; export questions carrying any of them."),
+        make_option('--page', dest='page', type='int', default=None,
+            help="Export questions anywhere in the page tree of this page id."),
+        make_option('--users', dest='users', default=None,
+            help="Comma-separated user ids to export."),
+        make_option('--modified-since', dest='modified_since', default=None,
+            help="Only export submissions changed at or after this date "
+                 "(YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)."),
+    )
+
+    def handle(self, *args, **options):
+        submissions = self.selected_submissions(options)
+        entries = catalog.entries()
+
+        if options['output']:
+            stream = open(options['output'], 'wb')
+        else:
+            stream = self.stdout
+        out = gzip.GzipFile(fileobj=stream, mode='wb') if options['gzip'] else stream
+
+        writer = WRITERS[options['format']](out)
+        exported = 0
+        started = time.time()
+        try:
+            for alias in shards():
+                exported += self.export(submissions.using(alias), entries, writer,
+                        options['chunk_size'])
+        finally:
+            if out is not stream:
+                out.close()
+            if stream is not self.stdout:
+                stream.close()
+
+        if options['output']:
+            elapsed = time.time() - started
+            self.stdout.write("Exported %d submissions in %.1fs\n" % (exported, elapsed))
+
+    def export(self, submissions, entries, writer, chunk_size):
+        """Write out ``submissions`` a chunk at a time, returning how many
+        were written."""
+        exported = 0
+        last = 0
+        while True:
+            # Keyset pagination keeps each query (and, on backends without
+            # chunked reads, each result set) to one chunk.
+            chunk = list(submissions.filter(pk__gt=last).values_list(
+                    'pk', 'user', 'question', 'answer', 'score',
+                    'modified')[:chunk_size].iterator())
+            if not chunk:
+                break
+            # Users may live in another database from their submissions.
+            user_ids = list(set([row[1] for row in chunk]))
+            usernames = {}
+            for i in range(0, len(user_ids), USER_BATCH_SIZE):
+                usernames.update(User.objects.filter(
+                        pk__in=user_ids[i:i + USER_BATCH_SIZE]).values_list('pk', 'username'))
+            for pk, user_id, slug, answer, score, modified in chunk:
+                entry = entries.get(slug)
+                writer.write({
+                    'user_id': user_id,
+                    'username': usernames.get(user_id, u""),
+                    'question': slug,
+                    'question_label': entry.label if entry else u"",
+                    'answer': answer,
+                    'answer_titles': self.answer_titles(entry, answer),
+                    'score': score,
+                    'modified': modified.strftime(DATETIME_FORMATS[0]),
+                })
+            exported += len(chunk)
+            last = chunk[-1][0]
+            if len(chunk) < chunk_size:
+                break
+        return exported
+
+    def answer_titles(self, entry, answer):
+        if entry is None or entry.question_type == 'F' or not answer:
+            return []
+        return [entry.titles.get(slug, slug) for slug in answer.split(',')]
+
+    def selected_submissions(self, options):
+        submissions = Submission.objects.order_by('pk')
+        slugs = None
+        if options['tags']:
+            slugs = set([slug for pk, slug, max_score
+                         in tag_index.questions(options['tags'].split(','))])
+        if options['page']:
+            try:
+                page = Page.objects.get(pk=options['page'])
+            except Page.DoesNotExist:
+                raise CommandError("Page %s does not exist." % options['page'])
+            in_tree = set([slug for slug, optional in tree_index.questions_in_tree(page)])
+            slugs = in_tree if slugs is None else slugs & in_tree
+        if slugs is not None:
+            entries = catalog.entries()
+            submissions = submissions.filter(question_ref__in=sorted(
+                    [entries[slug].pk for slug in slugs if slug in entries]))
+        if options['users']:
+            try:
+                users = [int(pk) for pk in options['users'].split(',')]
+            except ValueError:
+                raise CommandError("--users takes comma-separated user ids.")
+            submissions = submissions.filter(user__in=users)
+        if options['modified_since']:
+            submissions = submissions.filter(
+                    modified__gte=parse_datetime(options['modified_since']))
+        return submissions
@@ -1,17 +1,174 @@
 import sys
-from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
 from django.utils import simplejson
-from cms_saq.models import Question
 
-class Command(BaseCommand):
-    help = "Dumps django-cms-saq question tags."
+from cms_saq.catalog import catalog
+from cms_saq.models import Question, _insert_many, _delete_many
+
+
+class JSONObjectReader(object):
+    """Iterates over the ``(key, value)`` pairs of a top-level JSON object
+    read from a stream, holding only the current value in memory."""
+
+    def __init__(self, stream, read_size=64 * 1024):
+        self.stream = stream
+        self.read_size = read_size
+        self.decoder = simplejson.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
 
-    def handle(self, *args, **kwargs):
-        questions = simplejson.loads(sys.stdin.read())
-        for slug, tags in questions.iteritems():
+    def _fill(self):
+        """Read more input, dropping what has been consumed.  Returns False
+        at the end of the input."""
+        chunk = self.stream.read(self.read_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Skip whitespace and return the next character, or '' at the end
+        of the input."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at %r" % (
+                chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
             try:
-                question = Question.objects.get(slug=slug)
-                question.tags.clear()
-                question.tags.add(*tags)
-            except Question.DoesNotExist:
-                self.stdout.write("Skipping non-existent question: %s\n" % slug)
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A value running up to the end of the buffer may have been cut
+            # short (think numbers), so decode it again with more input.
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key, self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+class Command(BaseCommand):
+    args = "[file]"
+    help = "Loads django-cms-saq question tags, as dumped by dump_question_tags."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help="Questions compared per pair of queries (default 500)."),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help="Report what would change without writing anything."),
+    )
+
+    def handle(self, *args, **options):
+        """Replace the tags of each question in the input (a file, or stdin)
+        with those given, writing only the tags that differ, in a single
+        transaction."""
+        stream = open(args[0], 'rb') if args and args[0] != '-' else sys.stdin
+        self.using = router.db_for_write(Question)
+        self.dry_run = options['dry_run']
+        self.through = Question._meta.get_field('tags').through
+        self.content_type = ContentType.objects.get_for_model(Question)
+        self.tag_ids = {}
+        self.stats = dict.fromkeys(
+                ('questions', 'changed', 'added', 'removed', 'new_tags', 'missing'), 0)
+
+        try:
+            with transaction.commit_on_success(using=self.using):
+                batch = []
+                for item in JSONObjectReader(stream):
+                    batch.append(item)
+                    if len(batch) >= options['batch_size']:
+                        self.load_batch(batch)
+                        batch = []
+                self.load_batch(batch)
+        except ValueError, e:
+            raise CommandError("Invalid question tags JSON: %s" % e)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        if not self.dry_run and self.stats['changed']:
+            catalog.invalidate()
+        self.stdout.write("%s%d questions, %d changed: %d tags added, %d removed, "
+                "%d new tags, %d missing questions\n" % (
+                    "Dry run: " if self.dry_run else "", self.stats['questions'],
+                    self.stats['changed'], self.stats['added'], self.stats['removed'],
+                    self.stats['new_tags'], self.stats['missing']))
+
+    def load_batch(self, batch):
+        if not batch:
+            return
+        wanted = dict((slug, set(tags)) for slug, tags in batch)
+        questions = dict(Question.objects.using(self.using).filter(
+                slug__in=wanted.keys()).values_list('slug', 'pk'))
+        for slug in sorted(set(wanted) - set(questions)):
+            self.stats['missing'] += 1
+            self.stdout.write("Skipping non-existent question: %s\n" % slug)
+
+        current = {}
+        tagged = self.through.objects.using(self.using).filter(
+                content_type=self.content_type, object_id__in=questions.values())
+        for item_id, object_id, name in tagged.values_list('pk', 'object_id', 'tag__name'):
+            current.setdefault(object_id, {})[name] = item_id
+
+        deletes, inserts = [], []
+        for slug, question_id in questions.items():
+            have = current.get(question_id, {})
+            removed = [item_id for name, item_id in have.items() if name not in wanted[slug]]
+            added = [(question_id, name) for name in wanted[slug] if name not in have]
+            deletes.extend(removed)
+            inserts.extend(added)
+            if removed or added:
+                self.stats['changed'] += 1
+        self.stats['questions'] += len(questions)
+        self.stats['removed'] += len(deletes)
+        self.stats['added'] += len(inserts)
+
+        tag_ids = self.get_tag_ids(set([name for question_id, name in inserts]))
+        if not self.dry_run:
+            _delete_many(self.through, deletes, self.using)
+            _insert_many(self.through, ['tag', 'content_type', 'object_id'],
+                    [(tag_ids[name], self.content_type.pk, question_id)
+                     for question_id, name in inserts], self.using)
+
+    def get_tag_ids(self, names):
+        """Map tag names to tag ids, creating any tags that don't exist."""
+        tag_model = self.through.tag_model()
+        unknown = names - set(self.tag_ids)
+        if unknown:
+            existing = tag_model.objects.using(self.using).filter(name__in=unknown)
+            self.tag_ids.update(existing.values_list('name', 'pk'))
+            for name in sorted(unknown - set(self.tag_ids)):
+                self.stats['new_tags'] += 1
+                if self.dry_run:
+                    self.tag_ids[name] = None
+                else:
+                    self.tag_ids[name] = tag_model.objects.using(self.using).create(name=name).pk
+        return self.tag_ids
@@ -0,0 +1,15 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from cms_saq.models import TagScoreRollup
+
+class Command(BaseCommand):
+    help = "Rebuilds django-cms-saq tag score rollups from submissions."
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help="Number of users to rebuild per transaction (default 500)."),
+    )
+
+    def handle(self, *args, **options):
+        for rebuilt in TagScoreRollup.objects.rebuild_all(options['chunk_size']):
+            self.stdout.write("Rebuilt rollups for %d users\n" % rebuilt)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from cms_saq.models import ScoreDistribution
+
+class Command(BaseCommand):
+    help = ("Recomputes the django-cms-saq score distributions behind "
+            "percentiles from submissions.")
+
+    def handle(self, *args, **options):
+        ScoreDistribution.objects.rebuild()
+        keys = ScoreDistribution.objects.values('kind', 'key').distinct().count()
+        self.stdout.write("Refreshed %d score distributions\n" % keys)
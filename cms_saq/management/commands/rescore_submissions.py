@@ -0,0 +1,152 @@
+import datetime
+import sys
+import time
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from cms.models import Page
+from cms_saq.catalog import catalog, submission_cache
+from cms_saq.models import Answer, Question, Submission, TagScoreRollup
+from cms_saq.routers import shards
+
+
+def rescore_range(options, user_range=None, stdout=sys.stdout, using=None):
+    """Rescore the selected submissions in database ``using`` (optionally
+    only those of users in ``[start, end)``), one keyset-paginated batch at
+    a time.  Returns ``(seen, changed, invalid)`` counts."""
+    entries = catalog.entries()
+    submissions = Submission.objects.using(using).order_by('pk')
+    if options['questions'] is not None:
+        submissions = submissions.filter(question__in=options['questions'])
+    if user_range is not None:
+        submissions = submissions.filter(user__gte=user_range[0], user__lt=user_range[1])
+    label = " ".join(filter(None, [using, user_range and "users %d-%d" % user_range]))
+    label = label and label + ": "
+
+    seen = changed = invalid = 0
+    last = 0
+    started = time.time()
+    while True:
+        batch = list(submissions.filter(pk__gt=last).values_list(
+                'pk', 'user', 'question', 'answer', 'score')[:options['batch_size']])
+        if not batch:
+            break
+        last = batch[-1][0]
+        updates = {}
+        users = set()
+        for pk, user_id, question, answer, score in batch:
+            entry = entries.get(question)
+            if entry is None:
+                invalid += 1
+                continue
+            try:
+                new_score = entry.score(answer)
+            except Answer.DoesNotExist:
+                invalid += 1
+                continue
+            if new_score != score:
+                updates.setdefault(new_score, []).append(pk)
+                users.add(user_id)
+        seen += len(batch)
+        if updates and not options['dry_run']:
+            with transaction.commit_on_success(using=using):
+                for new_score, pks in updates.items():
+                    Submission.objects.using(using).filter(pk__in=pks).update(
+                            score=new_score, modified=datetime.datetime.now())
+            if getattr(settings, 'SAQ_SCORE_ROLLUPS', False):
+                TagScoreRollup.objects.rebuild(list(users), using=using)
+        changed += sum([len(pks) for pks in updates.values()])
+        elapsed = time.time() - started
+        stdout.write("%s%d rescored, %d changed, %d invalid (%.0f rows/s)\n" % (
+            label, seen, changed, invalid, seen / elapsed if elapsed else 0))
+        stdout.flush()
+    return seen, changed, invalid
+
+
+def close_connections():
+    for alias in connections:
+        connections[alias].close()
+
+
+def _rescore_worker(args):
+    # Each worker needs its own database connections, not the parent's.
+    close_connections()
+    options, user_range, using = args
+    return rescore_range(options, user_range, using=using)
+
+
+class Command(BaseCommand):
+    help = "Recomputes django-cms-saq submission scores against the current answers."
+    option_list = BaseCommand.option_list + (
+        make_option('--questions', dest='questions', default=None,
+            help="Comma-separated question slugs to rescore."),
+        make_option('--tags', dest='tags', default=None,
+            help="Comma-separated tags; rescore questions carrying any of them."),
+        make_option('--page', dest='page', type='int', default=None,
+            help="Rescore questions anywhere in the page tree of this page id."),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help="Submissions read and written per batch (default 1000)."),
+        make_option('--processes', dest='processes', type='int', default=1,
+            help="Split the work by user id range across this many processes."),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help="Report what would change without writing anything."),
+    )
+
+    def handle(self, *args, **options):
+        options['questions'] = self.selected_questions(options)
+        if options['questions'] == []:
+            raise CommandError("No questions match the given filters.")
+
+        started = time.time()
+        processes = options['processes']
+        if processes > 1:
+            tasks = []
+            for alias in shards():
+                bounds = Submission.objects.using(alias).aggregate(Min('user'), Max('user'))
+                low, high = bounds['user__min'], bounds['user__max']
+                if low is None:
+                    continue
+                step = (high - low) // processes + 1
+                tasks.extend([(options, (start, start + step), alias)
+                              for start in range(low, high + 1, step)])
+            if not tasks:
+                return
+            # Close the parent's connections so they aren't shared with the workers.
+            close_connections()
+            pool = Pool(processes)
+            results = pool.map(_rescore_worker, tasks)
+            pool.close()
+            pool.join()
+        else:
+            results = [rescore_range(options, stdout=self.stdout, using=alias)
+                       for alias in shards()]
+
+        seen, changed, invalid = [sum(r) for r in zip(*results)]
+        if changed and not options['dry_run']:
+            submission_cache.invalidate()
+        elapsed = time.time() - started
+        self.stdout.write("Done: %d rescored, %d changed, %d invalid in %.1fs (%.0f rows/s)\n" % (
+            seen, changed, invalid, elapsed, seen / elapsed if elapsed else 0))
+
+    def selected_questions(self, options):
+        """Slugs of the questions selected by the filters, or None for all."""
+        slugs = None
+        if options['questions']:
+            slugs = set(options['questions'].split(','))
+        if options['tags']:
+            tags = options['tags'].split(',')
+            tagged = Question.objects.filter(tags__name__in=tags).values_list('slug', flat=True)
+            slugs = set(tagged) if slugs is None else slugs & set(tagged)
+        if options['page']:
+            try:
+                page = Page.objects.get(pk=options['page'])
+            except Page.DoesNotExist:
+                raise CommandError("Page %s does not exist." % options['page'])
+            in_tree = Question.all_in_tree(page).values_list('slug', flat=True)
+            slugs = set(in_tree) if slugs is None else slugs & set(in_tree)
+        return None if slugs is None else sorted(slugs)
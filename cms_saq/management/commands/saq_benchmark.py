@@ -0,0 +1,59 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+import cms_saq
+from cms_saq.benchmarks.cases import Cases, measure
+
+class Command(BaseCommand):
+    help = ("Benchmarks django-cms-saq against data from saq_generate_data, "
+            "reporting JSON.  Note that the submit benchmark writes submissions.")
+    option_list = BaseCommand.option_list + (
+        make_option('--prefix', dest='prefix', default='bench',
+            help="Prefix the data was generated with (default 'bench')."),
+        make_option('--iterations', dest='iterations', type='int', default=20,
+            help="Timed runs of each benchmark (default 20)."),
+        make_option('--warmup', dest='warmup', type='int', default=1,
+            help="Untimed runs of each benchmark first (default 1)."),
+        make_option('--only', dest='only', default=None,
+            help="Comma-separated benchmark names to run."),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help="Random seed (default 0)."),
+        make_option('--output', dest='output', default=None,
+            help="File to write the JSON report to (default stdout)."),
+    )
+
+    def handle(self, *args, **options):
+        cases = Cases(options['prefix'], seed=options['seed'])
+        selected = cases.all()
+        if options['only']:
+            only = options['only'].split(',')
+            unknown = set(only) - set([name for name, func in selected])
+            if unknown:
+                raise CommandError("Unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+            selected = [(name, func) for name, func in selected if name in only]
+
+        results = []
+        for name, func in selected:
+            results.append(measure(name, func, options['iterations'], options['warmup']))
+            sys.stderr.write("%s: %.2fms, %.1f queries\n" % (name,
+                results[-1]['wall_time_per_iteration'] * 1000,
+                results[-1]['queries_per_iteration']))
+
+        report = simplejson.dumps({
+            'version': cms_saq.__version__,
+            'database': connection.vendor,
+            'data': cases.summary(),
+            'benchmarks': results,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            out = open(options['output'], 'w')
+            try:
+                out.write(report)
+            finally:
+                out.close()
+        else:
+            self.stdout.write(report + "\n")
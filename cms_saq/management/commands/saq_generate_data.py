@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cms_saq.benchmarks.data import generate
+
+class Command(BaseCommand):
+    help = "Generates a synthetic django-cms-saq questionnaire for benchmarking."
+    option_list = BaseCommand.option_list + (
+        make_option('--prefix', dest='prefix', default='bench',
+            help="Prefix for generated page, question, tag and user names (default 'bench')."),
+        make_option('--pages', dest='pages', type='int', default=10,
+            help="Number of pages in the tree (default 10)."),
+        make_option('--questions', dest='questions', type='int', default=5,
+            help="Questions of each plugin type per page (default 5)."),
+        make_option('--answers', dest='answers', type='int', default=4,
+            help="Answers per choice question (default 4)."),
+        make_option('--tags', dest='tags', type='int', default=5,
+            help="Number of tags, and so scoring sections (default 5)."),
+        make_option('--users', dest='users', type='int', default=100,
+            help="Number of users (default 100)."),
+        make_option('--density', dest='density', type='float', default=0.8,
+            help="Probability that a user has answered any one question (default 0.8)."),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help="Random seed (default 0)."),
+    )
+
+    def handle(self, *args, **options):
+        with transaction.commit_on_success():
+            root = generate(
+                prefix=options['prefix'],
+                pages=options['pages'],
+                questions=options['questions'],
+                answers=options['answers'],
+                tags=options['tags'],
+                users=options['users'],
+                density=options['density'],
+                seed=options['seed'],
+                log=self.stdout.write,
+            )
+        self.stdout.write("Generated questionnaire rooted at page %s\n" % root.pk)
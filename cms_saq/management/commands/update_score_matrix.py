@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = "<directory>"
+    help = ("Brings the django-cms-saq score matrix in the given directory up "
+            "to date with submissions, creating it if need be.  Needs NumPy.")
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help="Rebuild the matrix from every submission."),
+        make_option('--overlap', dest='overlap', type='int', default=300,
+            help="Also reapply submissions modified this many seconds before "
+                 "the last update (default 300)."),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=2000,
+            help="Number of submissions to read per query (default 2000)."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the matrix's directory.")
+        try:
+            from cms_saq.cohort import update_score_matrix
+        except ImportError:
+            raise CommandError("The score matrix needs NumPy.")
+        applied, matrix = update_score_matrix(args[0], rebuild=options['rebuild'],
+                overlap=options['overlap'], chunk_size=options['chunk_size'])
+        self.stdout.write("Applied %d submissions; the matrix has %d users and "
+                          "%d questions\n" % (applied, len(matrix.user_ids), len(matrix.slugs)))
@@ -1,9 +1,23 @@
-from django.db import models
-from django.db.models import Max, Sum
-
-from cms.models import CMSPlugin, Page, Placeholder
+import datetime
+import math
+import sys
+
+from django.conf import settings
+from django.db import models, connections, router, transaction, IntegrityError
+from django.db.models import Count, F, Sum
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+
+from cms.models import CMSPlugin, Page
+from cms.signals import page_moved, post_publish
 from cms.models.fields import PageField
 from taggit.managers import TaggableManager
+from taggit.models import Tag
+
+from cms_saq.catalog import catalog, submission_cache, tag_index, tree_index
+from cms_saq.routers import group_by_shard, shard_for_user, shards
+from cms_saq.signals import submissions_saved
 
 class Answer(models.Model):
     title = models.CharField(max_length=255)
@@ -46,41 +60,38 @@ class Question(CMSPlugin):
 
     @staticmethod
     def all_in_tree(page):
-        root = page.get_root()
-        # Remember that there might be questions on the root page as well!
-        tree = root.get_descendants() | Page.objects.filter(id=root.id)
-        placeholders = Placeholder.objects.filter(page__in=tree)
-        return Question.objects.filter(placeholder__in=placeholders)
+        slugs = [slug for slug, optional in tree_index.questions_in_tree(page)]
+        return Question.objects.filter(slug__in=slugs)
 
     @staticmethod
     def all_in_page(page):
-        placeholders = Placeholder.objects.filter(page=page)
-        return Question.objects.filter(placeholder__in=placeholders)
+        slugs = [slug for slug, optional in tree_index.questions_in_page(page)]
+        return Question.objects.filter(slug__in=slugs)
+
+    @property
+    def catalog_entry(self):
+        return catalog.get(self.slug)
 
     def score(self, answers):
+        entry = self.catalog_entry
+        if entry is not None:
+            return entry.score(answers)
+        # not in this process's catalog yet (eg. unsaved), so ask the database
         if self.question_type == 'F':
             return 0
-        elif self.question_type == 'S':
-            return self.answers.get(slug=answers).score
-        elif self.question_type == 'M':
-            answers_list = answers.split(',')
-            return sum([self.answers.get(slug=a).score for a in answers_list])
+        slugs = answers.split(',') if self.question_type == 'M' else [answers]
+        return sum([self.answers.get(slug=slug).score for slug in slugs])
 
     @property
     def max_score(self):
-        if not hasattr(self, '_max_score'):
-            if self.question_type == "S":
-                self._max_score = self.answers.aggregate(Max('score'))['score__max']
-            elif self.question_type == "M":
-                self._max_score = self.answers.aggregate(Sum('score'))['score__sum']
-            else:
-                self._max_score = None # don't score free-text answers
-        return self._max_score
-
-    def percent_score_for_user(self, user):
+        entry = self.catalog_entry
+        return entry.max_score if entry else None
+
+    def percent_score_for_user(self, user, using=None):
         if self.max_score:
             try:
-                score = Submission.objects.get(question=self.slug, user=user).score
+                score = Submission.objects.using(using or shard_for_user(user)).get(
+                        question_ref=self.pk, user=user).score
             except Submission.DoesNotExist:
                 return 0
             return 100.0 * score / self.max_score
@@ -90,15 +101,184 @@ class Question(CMSPlugin):
     def __unicode__(self):
         return self.slug
 
+def _sqlite_version(connection):
+    """The version of the SQLite library behind ``connection``, from the
+    DB-API module its backend imported (pysqlite2 or sqlite3), which needn't
+    be linked against the same SQLite as the standard library's."""
+    Database = getattr(connection, 'Database', None) or \
+            sys.modules[type(connection).__module__].Database
+    return Database.sqlite_version_info
+
+
+def _native_upsert(connection):
+    """Whether ``connection`` can insert several rows, updating those that
+    clash with existing ones, in one statement."""
+    if connection.vendor == 'sqlite':
+        # ON CONFLICT ... DO UPDATE arrived in SQLite 3.24
+        return _sqlite_version(connection) >= (3, 24, 0)
+    return connection.vendor in ('postgresql', 'mysql')
+
+
+def _upsert_rows(model, field_names, key_names, rows, using, increment=()):
+    """Insert ``rows`` of values for ``field_names`` into ``model``'s table
+    in one statement, updating the rows that clash on ``key_names`` instead:
+    fields in ``increment`` are added to, the rest overwritten.  Only for
+    connections where ``_native_upsert`` holds."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [opts.get_field(name) for name in field_names]
+    keys = [opts.get_field(name).column for name in key_names]
+    table = qn(opts.db_table)
+    params = []
+    for row in rows:
+        params.extend([f.get_db_prep_save(value, connection=connection)
+                       for f, value in zip(fields, row)])
+    row = "(%s)" % ", ".join(["%s"] * len(fields))
+    sql = "INSERT INTO %s (%s) VALUES %s" % (
+        table,
+        ", ".join([qn(f.column) for f in fields]),
+        ", ".join([row] * len(rows)),
+    )
+    updates = [f for f in fields if f.column not in keys]
+    if connection.vendor == 'mysql':
+        new = "VALUES(%s)"
+        sql += " ON DUPLICATE KEY UPDATE "
+    else:
+        new = "EXCLUDED.%s"
+        sql += " ON CONFLICT (%s) DO UPDATE SET " % ", ".join([qn(c) for c in keys])
+    sql += ", ".join([
+        "%s = %s.%s + %s" % (qn(f.column), table, qn(f.column), new % qn(f.column))
+        if f.name in increment else "%s = %s" % (qn(f.column), new % qn(f.column))
+        for f in updates])
+    connection.cursor().execute(sql, params)
+
+
+# first key of the PostgreSQL advisory locks serialising each user's submits
+SUBMIT_LOCK_KEY = 0x5a51
+
+
+class SubmissionManager(models.Manager):
+    # rows per INSERT statement; keeps well under SQLite's 999 parameters
+    upsert_batch_size = 100
+
+    def save_batch(self, user, submissions, using=None):
+        """Upsert ``user``'s ``submissions`` in a single transaction, sending
+        ``submissions_saved`` before it commits, then invalidate the user's
+        cached submissions.  An empty batch does nothing."""
+        if not submissions:
+            return
+        using = using or shard_for_user(user) or router.db_for_write(self.model)
+        with transaction.commit_on_success(using=using):
+            previous = self._locked_previous(user, [s.question for s in submissions], using)
+            self.upsert(submissions, using=using)
+            submissions_saved.send(sender=self.model, user=user,
+                    submissions=submissions, previous=previous, using=using)
+        submission_cache.invalidate_user(user)
+
+    def _locked_previous(self, user, questions, using):
+        """``{question: (answer, score)}`` for ``user``'s existing submissions
+        to ``questions``, locked until the transaction ends, so that
+        concurrent submits by the same user see each other's answers.
+        (Django 1.3 has no ``select_for_update``.)"""
+        connection = connections[using]
+        cursor = connection.cursor()
+        if connection.vendor == 'postgresql':
+            # first answers have no rows to lock, so take a lock on the user
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)",
+                    [SUBMIT_LOCK_KEY, getattr(user, 'pk', user)])
+        rows = self.using(using).filter(user=user, question__in=questions).values_list(
+                'question', 'answer', 'score')
+        sql, params = rows.query.get_compiler(using).as_sql()
+        # SQLite only has one writer at a time anyway
+        if connection.vendor in ('postgresql', 'mysql'):
+            sql += " FOR UPDATE"
+        cursor.execute(sql, params)
+        return dict((question, (answer, score)) for question, answer, score in cursor.fetchall())
+
+    def choosing(self, question, answer, using=None):
+        """Submissions to the question with slug ``question`` that chose the
+        answer with slug ``answer``, found through their recorded choices.
+        When sharding, this covers the shard ``using`` only."""
+        entry = catalog.get(question)
+        answer_id = entry.answer_ids.get(answer) if entry else None
+        if answer_id is None:
+            return self.none()
+        return self.using(using).filter(choices__answer=answer_id)
+
+    def upsert(self, submissions, using=None):
+        """Insert or update a batch of unsaved ``Submission`` instances,
+        keyed on ``(question, user)``.
+
+        Uses a multi-row INSERT ... ON CONFLICT DO UPDATE on PostgreSQL and
+        SQLite 3.24+, INSERT ... ON DUPLICATE KEY UPDATE on MySQL, and falls
+        back to update-then-create on anything else.  Submissions are also
+        unique on ``(user, question_ref)``, but that never clashes on its
+        own: ``question_ref`` is looked up from ``question``, and renaming a
+        question renames its submissions as it saves, so a row with the same
+        ``question_ref`` also has the same ``question``.  When sharding,
+        submissions go to their users' shards unless ``using`` is given.  If
+        a question and user come up more than once, the last one wins.
+        """
+        latest = {}
+        for submission in submissions:
+            latest[(submission.question, submission.user_id)] = submission
+        # a row can't be upserted twice in one statement
+        submissions = [s for s in submissions
+                       if latest[(s.question, s.user_id)] is s]
+        if using is None and getattr(settings, 'SAQ_SHARDS', None):
+            by_shard = {}
+            for submission in submissions:
+                by_shard.setdefault(shard_for_user(submission.user_id), []).append(submission)
+            for alias, batch in by_shard.items():
+                self.upsert(batch, using=alias)
+            return
+        using = using or router.db_for_write(self.model)
+        entries = catalog.entries()
+        for submission in submissions:
+            if submission.question_ref_id is None and submission.question in entries:
+                submission.question_ref_id = entries[submission.question].pk
+        if _native_upsert(connections[using]):
+            for i in range(0, len(submissions), self.upsert_batch_size):
+                self._upsert_batch(submissions[i:i + self.upsert_batch_size], using)
+            transaction.commit_unless_managed(using=using)
+        else:
+            for submission in submissions:
+                self._update_or_create(submission, using)
+
+    def _upsert_batch(self, submissions, using):
+        fields = [f for f in self.model._meta.local_fields
+                  if not isinstance(f, models.AutoField)]
+        _upsert_rows(self.model, [f.name for f in fields], ['question', 'user'],
+                [[f.pre_save(submission, True) for f in fields] for submission in submissions],
+                using)
+
+    def _update_or_create(self, submission, using):
+        filter_attrs = {'user': submission.user_id, 'question': submission.question}
+        attrs = {'answer': submission.answer, 'score': submission.score,
+                 'question_ref': submission.question_ref_id,
+                 'modified': datetime.datetime.now()}
+        rows = self.using(using).filter(**filter_attrs).update(**attrs)
+        if not rows:
+            submission.save(using=using)
+
+
 class Submission(models.Model):
     question = models.SlugField()
     answer = models.TextField(blank=True)
     score = models.IntegerField()
-    user = models.ForeignKey('auth.User', related_name='saq_submissions')
+    user = models.ForeignKey('auth.User', related_name='saq_submissions',
+            on_delete=models.DO_NOTHING)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+    # the question as an integer key, for joins; ``question`` stays the API
+    question_ref = models.ForeignKey(Question, null=True, blank=True,
+            related_name='submissions', on_delete=models.DO_NOTHING)
 
     class Meta:
         ordering = ('user', 'question')
-        unique_together = ('question', 'user')
+        unique_together = (('question', 'user'), ('user', 'question_ref'))
+
+    objects = SubmissionManager()
 
     def answer_list(self):
         return self.answer.split(",")
@@ -117,8 +297,11 @@ class FormNav(CMSPlugin):
 
 
 class SectionedScoring(CMSPlugin):
-    def scores_for_user(self, user):
-        scores = [[s.label, s.score_for_user(user)] for s in self.sections.all()]
+    show_percentiles = models.BooleanField(default=False,
+            help_text="Show what percentage of respondents each score beats.")
+
+    def scores_for_user(self, user, using=None):
+        scores = [[s.label, s.score_for_user(user, using)] for s in self.sections.all()]
         overall = sum([s[1] for s in scores]) / len(scores)
         return [scores, overall]
 
@@ -131,23 +314,32 @@ class ScoreSection(models.Model):
     class Meta:
         ordering = ('order', 'label')
 
-    def score_for_user(self, user):
-        return aggregate_score_for_user_by_tags(user, [self.tag])
+    def score_for_user(self, user, using=None):
+        return aggregate_score_for_user_by_tags(user, [self.tag], using)
 
 
 class ProgressBar(CMSPlugin):
     count_optional = models.BooleanField(default=False)
 
-    def progress_for_user(self, user):
-        subs = Submission.objects.filter(user=user).values_list('question', flat=True)
-        questions = Question.all_in_tree(self.page)
-
-        if not self.count_optional:
-            questions = questions.filter(optional=False)
-
-        answered = questions.filter(slug__in=subs)
-
-        return (answered.count(), questions.count())
+    def progress_for_user(self, user, using=None):
+        page = self.page
+        questions = tree_index.questions_in_tree(page)
+        slugs = [slug for slug, optional in questions
+                if self.count_optional or not optional]
+        if getattr(settings, 'SAQ_PROGRESS_COUNTERS', False):
+            if getattr(user, 'pk', None) is None:
+                return (0, len(slugs))
+            try:
+                counter = ProgressCounter.objects.using(using or shard_for_user(user)).get(
+                        user=user, tree_id=page.tree_id)
+            except ProgressCounter.DoesNotExist:
+                return (0, len(slugs))
+            # counters lag behind questions being removed until rebuilt
+            if self.count_optional:
+                return (min(counter.answered_total, len(slugs)), len(slugs))
+            return (min(counter.answered_required, len(slugs)), len(slugs))
+        submissions = submission_cache.get(user, using)
+        return (len([slug for slug in slugs if slug in submissions]), len(slugs))
 
 
 class BulkAnswer(CMSPlugin):
@@ -158,10 +350,320 @@ class BulkAnswer(CMSPlugin):
     )
 
 
-def aggregate_score_for_user_by_questions(user, questions):
+class PerUserManager(models.Manager):
+    """Manager of a table derived from each user's submissions, which
+    subclasses recompute for a batch of users on one database in
+    ``_rebuild(user_ids, using)``."""
+
+    def rebuild(self, user_ids, using=None):
+        """Recompute the rows of ``user_ids`` from their submissions, on
+        ``using`` or, when sharding, on each user's shard."""
+        if using is None and getattr(settings, 'SAQ_SHARDS', None):
+            for alias, ids in group_by_shard(user_ids).items():
+                self._rebuild(ids, alias)
+        else:
+            self._rebuild(user_ids, using or router.db_for_write(self.model))
+
+    def rebuild_all(self, chunk_size=500):
+        """Recompute every user's rows, ``chunk_size`` users per transaction,
+        yielding how many users have been done after each chunk."""
+        users = User.objects.order_by('pk').values_list('pk', flat=True)
+        last, rebuilt = 0, 0
+        while True:
+            chunk = list(users.filter(pk__gt=last)[:chunk_size])
+            if not chunk:
+                break
+            self.rebuild(chunk)
+            last = chunk[-1]
+            rebuilt += len(chunk)
+            yield rebuilt
+
+
+class TagScoreRollupManager(PerUserManager):
+
+    def _rebuild(self, user_ids, using):
+        """Recompute the rollups for ``user_ids`` from their submissions."""
+        entries = catalog.entries()
+        totals = {}
+        submissions = Submission.objects.using(using).filter(user__in=user_ids)
+        for user_id, question, score in submissions.values_list('user', 'question', 'score').iterator():
+            entry = entries.get(question)
+            if entry is None or not entry.max_score:
+                continue
+            percent = entry.percent_score(score)
+            for tag in entry.tags:
+                total = totals.setdefault((user_id, tag), [0.0, 0])
+                total[0] += percent
+                total[1] += 1
+        with transaction.commit_on_success(using=using):
+            self.using(using).filter(user__in=user_ids).delete()
+            _insert_many(self.model, ['user', 'tag', 'percent_sum', 'count'],
+                    [(user_id, tag, t[0], t[1]) for (user_id, tag), t in totals.items()],
+                    using)
+
+
+class TagScoreRollup(models.Model):
+    """Running total of a user's percent scores for the questions carrying a
+    tag, kept up to date on submit when ``SAQ_SCORE_ROLLUPS`` is enabled.
+
+    ``count`` is the number of scored questions the user has answered;
+    unanswered questions contribute nothing to ``percent_sum``.
+    """
+    user = models.ForeignKey('auth.User', related_name='saq_tag_rollups',
+            on_delete=models.DO_NOTHING)
+    tag = models.CharField(max_length=100)
+    percent_sum = models.FloatField(default=0)
+    count = models.IntegerField(default=0)
+
+    objects = TagScoreRollupManager()
+
+    class Meta:
+        unique_together = ('user', 'tag')
+
+    def __unicode__(self):
+        return u"%s rollup for %s" % (self.user, self.tag)
+
+
+# parameters per multi-row statement; keeps under SQLite's 999
+STATEMENT_PARAMETERS = 900
+
+
+def _insert_many(model, field_names, rows, using):
+    """Insert ``rows`` of values for ``field_names`` with multi-row INSERTs
+    of up to ``STATEMENT_PARAMETERS`` values each."""
+    rows = list(rows)
+    if not rows:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [model._meta.get_field(name) for name in field_names]
+    per_statement = max(1, STATEMENT_PARAMETERS // len(fields))
+    if connection.vendor == 'sqlite' and _sqlite_version(connection) < (3, 7, 11):
+        # no multi-row VALUES before SQLite 3.7.11
+        per_statement = 1
+    row_sql = "(%s)" % ", ".join(["%s"] * len(fields))
+    cursor = connection.cursor()
+    for i in range(0, len(rows), per_statement):
+        chunk = rows[i:i + per_statement]
+        params = []
+        for row in chunk:
+            params.extend([f.get_db_prep_save(value, connection=connection)
+                           for f, value in zip(fields, row)])
+        cursor.execute("INSERT INTO %s (%s) VALUES %s" % (
+            qn(model._meta.db_table),
+            ", ".join([qn(f.column) for f in fields]),
+            ", ".join([row_sql] * len(chunk)),
+        ), params)
+    transaction.commit_unless_managed(using=using)
+
+
+def _delete_many(model, pks, using):
+    """Delete the rows of ``model`` with primary keys ``pks`` with DELETEs
+    of up to ``STATEMENT_PARAMETERS`` keys each, bypassing the collector and
+    delete signals."""
+    pks = list(pks)
+    if not pks:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for i in range(0, len(pks), STATEMENT_PARAMETERS):
+        chunk = pks[i:i + STATEMENT_PARAMETERS]
+        cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+            qn(model._meta.db_table), qn(model._meta.pk.column),
+            ", ".join(["%s"] * len(chunk))), chunk)
+    transaction.commit_unless_managed(using=using)
+
+
+def _increment_rows(model, key_names, field_names, rows, using):
+    """Add ``rows`` of values for ``field_names``, keyed on ``key_names``,
+    to the existing rows of ``model``, creating any that are missing, with
+    one native upsert where the database has one."""
+    if not rows:
+        return
+    if _native_upsert(connections[using]):
+        _upsert_rows(model, key_names + field_names, key_names, rows, using,
+                     increment=field_names)
+        return
+    manager = model._default_manager.db_manager(using)
+    for row in rows:
+        keys = dict(zip(['%s__exact' % name for name in key_names], row))
+        values = dict(zip(field_names, row[len(key_names):]))
+        increments = dict((name, F(name) + value) for name, value in values.items())
+        if manager.filter(**keys).update(**increments):
+            continue
+        savepoint = transaction.savepoint(using=using)
+        try:
+            manager.create(**dict(zip([model._meta.get_field(name).attname
+                                       for name in key_names], row), **values))
+        except IntegrityError:
+            # created by a concurrent submit since the update
+            transaction.savepoint_rollback(savepoint, using=using)
+            manager.filter(**keys).update(**increments)
+        else:
+            transaction.savepoint_commit(savepoint, using=using)
+
+
+def update_tag_rollups(sender, user, submissions, previous, using, **kwargs):
+    """Apply the change in percent score of each submission to the rollups
+    of its question's tags.  Old scores are re-expressed against the current
+    max scores, so changes to answer scores or tags need a rebuild."""
+    if not getattr(settings, 'SAQ_SCORE_ROLLUPS', False):
+        return
+    entries = catalog.entries()
+    deltas = {}
+    for submission in submissions:
+        entry = entries.get(submission.question)
+        if entry is None or not entry.max_score:
+            continue
+        percent = entry.percent_score(submission.score)
+        count = 1
+        if submission.question in previous:
+            percent -= entry.percent_score(previous[submission.question][1])
+            count = 0
+        for tag in entry.tags:
+            delta = deltas.setdefault(tag, [0.0, 0])
+            delta[0] += percent
+            delta[1] += count
+    _increment_rows(TagScoreRollup, ['user', 'tag'], ['percent_sum', 'count'],
+            [(user.pk, tag, percent, count) for tag, (percent, count) in deltas.items()],
+            using)
+
+submissions_saved.connect(update_tag_rollups)
+
+
+class ProgressCounterManager(PerUserManager):
+
+    def _rebuild(self, user_ids, using):
+        """Recount the questions answered by ``user_ids`` in every tree."""
+        entries = catalog.entries()
+        trees = tree_index.trees_by_question()
+        counts = {}
+        submissions = Submission.objects.using(using).filter(user__in=user_ids)
+        for user_id, question in submissions.values_list('user', 'question').iterator():
+            entry = entries.get(question)
+            for tree_id in trees.get(question, ()):
+                count = counts.setdefault((user_id, tree_id), [0, 0])
+                count[1] += 1
+                if entry is not None and not entry.optional:
+                    count[0] += 1
+        with transaction.commit_on_success(using=using):
+            self.using(using).filter(user__in=user_ids).delete()
+            _insert_many(self.model, ['user', 'tree_id', 'answered_required', 'answered_total'],
+                    [(user_id, tree_id, c[0], c[1]) for (user_id, tree_id), c in counts.items()],
+                    using)
+
+
+class ProgressCounter(models.Model):
+    """How many of the questions in a page tree a user has answered, kept up
+    to date on submit when ``SAQ_PROGRESS_COUNTERS`` is enabled."""
+    user = models.ForeignKey('auth.User', related_name='saq_progress_counters',
+            on_delete=models.DO_NOTHING)
+    tree_id = models.PositiveIntegerField()
+    answered_required = models.IntegerField(default=0)
+    answered_total = models.IntegerField(default=0)
+
+    objects = ProgressCounterManager()
+
+    class Meta:
+        unique_together = ('user', 'tree_id')
+
+    def __unicode__(self):
+        return u"%s progress in tree %s" % (self.user, self.tree_id)
+
+
+def update_progress_counters(sender, user, submissions, previous, using, **kwargs):
+    """Count each first answer to a question towards the trees it is in.
+    Moving questions or pages around needs a rebuild."""
+    if not getattr(settings, 'SAQ_PROGRESS_COUNTERS', False):
+        return
+    new = [s.question for s in submissions if s.question not in previous]
+    if not new:
+        return
+    entries = catalog.entries()
+    trees = tree_index.trees_by_question()
+    deltas = {}
+    for question in new:
+        entry = entries.get(question)
+        for tree_id in trees.get(question, ()):
+            delta = deltas.setdefault(tree_id, [0, 0])
+            delta[1] += 1
+            if entry is not None and not entry.optional:
+                delta[0] += 1
+    _increment_rows(ProgressCounter, ['user', 'tree_id'], ['answered_required', 'answered_total'],
+            [(user.pk, tree_id, required, total) for tree_id, (required, total) in deltas.items()],
+            using)
+
+submissions_saved.connect(update_progress_counters)
+
+
+class SubmissionChoiceManager(models.Manager):
+
+    def rebuild(self, submissions, using=None):
+        """Replace the choices recorded for ``submissions``, a list of
+        ``(pk, question, answer)`` tuples."""
+        using = using or router.db_for_write(self.model)
+        entries = catalog.entries()
+        rows = []
+        for pk, question, answer in submissions:
+            entry = entries.get(question)
+            if entry is not None:
+                rows.extend([(pk, answer_id) for answer_id in entry.choice_ids(answer)])
+        with transaction.commit_on_success(using=using):
+            self.using(using).filter(submission__in=[s[0] for s in submissions]).delete()
+            _insert_many(self.model, ['submission', 'answer'], rows, using)
+
+    def answer_counts(self, question, using=None):
+        """Return ``{answer_slug: count}`` of how many submissions chose each
+        answer to the question with slug ``question``, across every shard
+        unless ``using`` is given."""
+        entry = catalog.get(question)
+        if entry is None or not entry.answer_ids:
+            return {}
+        slugs = dict((pk, slug) for slug, pk in entry.answer_ids.items())
+        result = dict.fromkeys(entry.answer_ids, 0)
+        for alias in ([using] if using else shards()):
+            counts = self.using(alias or router.db_for_read(self.model)).filter(
+                    answer__in=slugs.keys()).values_list('answer').annotate(Count('pk'))
+            for answer_id, count in counts:
+                result[slugs[answer_id]] += count
+        return result
+
+
+class SubmissionChoice(models.Model):
+    """One answer chosen in a single- or multi-choice submission, so that
+    submissions can be queried by the answers chosen."""
+    submission = models.ForeignKey(Submission, related_name='choices')
+    answer = models.ForeignKey(Answer, related_name='choices',
+            on_delete=models.DO_NOTHING)
+
+    objects = SubmissionChoiceManager()
+
+    class Meta:
+        # answer first, so the index serves lookups and counts by answer
+        unique_together = ('answer', 'submission')
+
+    def __unicode__(self):
+        return u"%s chose %s" % (self.submission, self.answer)
+
+
+def update_submission_choices(sender, user, submissions, previous, using, **kwargs):
+    """Record the choices of each submission whose answer changed."""
+    changed = [s.question for s in submissions
+               if previous.get(s.question, (None, None))[0] != s.answer]
+    if not changed:
+        return
+    saved = Submission.objects.using(using).filter(user=user, question__in=changed)
+    SubmissionChoice.objects.rebuild(
+            list(saved.values_list('pk', 'question', 'answer')), using=using)
+
+submissions_saved.connect(update_submission_choices)
+
+
+def aggregate_score_for_user_by_questions(user, questions, using=None):
     scores = []
     for question in questions:
-        score = question.percent_score_for_user(user)
+        score = question.percent_score_for_user(user, using)
         if score is not None:
             scores.append(score)
     if len(scores):
@@ -170,15 +672,349 @@ def aggregate_score_for_user_by_questions(user, questions):
         return 0
 
 
-def aggregate_score_for_user_by_tags(user, tags):
-    questions = Question.objects.filter(tags__name__in=tags).distinct()
-    scores = []
-    for question in questions:
-        score = question.percent_score_for_user(user)
-        if score is not None:
-            scores.append(score)
-    if len(scores):
-        return sum(scores) / len(scores)
-    else:
+def aggregate_score_for_user_by_tags(user, tags, using=None):
+    """Like ``aggregate_scores_for_users_by_tags`` for one user, but scored
+    from the submission cache when not read from the rollups."""
+    if getattr(user, 'pk', None) is None:
         return 0
+    if getattr(settings, 'SAQ_SCORE_ROLLUPS', False):
+        rolled_up = _rollup_scores_for_users_by_tags([user.pk], tags, using)
+        if rolled_up is not None:
+            return rolled_up.get(user.pk, 0)
+    return score_submissions_by_tags(submission_cache.get(user, using), tags)
+
+
+def score_submissions_by_tags(submissions, tags):
+    """Average percent score over the questions tagged with any of ``tags``
+    for one user's ``{slug: (answer, score)}``, as kept in the submission
+    cache.  Unanswered questions count as zero."""
+    scores = [100.0 * submissions[slug][1] / max_score if slug in submissions else 0
+              for pk, slug, max_score in tag_index.questions(tags) if max_score]
+    if not scores:
+        return 0
+    return sum(scores) / len(scores)
+
+
+# users per query when scoring many at once
+USER_BATCH_SIZE = 500
+
+
+def _rollup_scores_for_users_by_tags(user_ids, tags, using):
+    """Read tag aggregates from the rollup table, or return None if the tags
+    share questions (their rollups can't simply be added together)."""
+    if tag_index.overlap(tags):
+        return None
+    count = len(tag_index.scored(tags))
+    if not count:
+        return {}
+    if using is None and getattr(settings, 'SAQ_SHARDS', None):
+        by_shard = group_by_shard(user_ids).items()
+    else:
+        by_shard = [(using or router.db_for_read(TagScoreRollup), user_ids)]
+    scores = {}
+    for alias, ids in by_shard:
+        rollups = TagScoreRollup.objects.using(alias)
+        for i in range(0, len(ids), USER_BATCH_SIZE):
+            batch = rollups.filter(user__in=ids[i:i + USER_BATCH_SIZE], tag__in=tags)
+            for row in batch.values('user').annotate(percent_sum=Sum('percent_sum')):
+                scores[row['user']] = row['percent_sum'] / count
+    return scores
+
+
+def aggregate_scores_for_users_by_tags(users, tags, using=None):
+    """Average percent score over the questions tagged with any of ``tags``,
+    for each of ``users`` (instances or ids).  Returns ``{user_id: score}``.
+
+    Equivalent to calling ``aggregate_score_for_user_by_tags`` per user, but
+    runs one query per 500 users: max scores come from the tag index,
+    unanswered questions count as zero, and the percentages and averages are
+    computed in the database.  When sharding, and ``using`` isn't given, each
+    shard is queried for its own users.
+    """
+    user_ids = [getattr(u, 'pk', u) for u in users]
+    scores = dict.fromkeys(user_ids, 0)
+    if not user_ids or not tags:
+        return scores
+    if getattr(settings, 'SAQ_SCORE_ROLLUPS', False):
+        rolled_up = _rollup_scores_for_users_by_tags(user_ids, tags, using)
+        if rolled_up is not None:
+            scores.update(rolled_up)
+            return scores
+    maxima = tag_index.scored(tags)
+    if not maxima:
+        return scores
+    if using is None and getattr(settings, 'SAQ_SHARDS', None):
+        by_shard = group_by_shard(user_ids).items()
+    else:
+        by_shard = [(using or router.db_for_read(Submission), user_ids)]
+
+    for alias, ids in by_shard:
+        connection = connections[alias]
+        qn = connection.ops.quote_name
+        # The question ids and max scores are integers, so they are written
+        # into the SQL, leaving SQLite's limit on parameters to the users.
+        sql = """
+            SELECT s.%(user)s, SUM(100.0 * s.%(score)s / CASE s.%(question)s %(maxima)s END) / %%s
+            FROM %(submission)s s
+            WHERE s.%(question)s IN (%(questions)s) AND s.%(user)s IN (%(users)s)
+            GROUP BY s.%(user)s
+        """ % {
+            'user': qn(Submission._meta.get_field('user').column),
+            'score': qn('score'),
+            'question': qn(Submission._meta.get_field('question_ref').column),
+            'submission': qn(Submission._meta.db_table),
+            'maxima': " ".join(["WHEN %d THEN %d" % (pk, max_score)
+                                for pk, max_score in sorted(maxima.items())]),
+            'questions': ", ".join(["%d" % pk for pk in sorted(maxima)]),
+            'users': '{users}',
+        }
+        cursor = connection.cursor()
+        for i in range(0, len(ids), USER_BATCH_SIZE):
+            batch = ids[i:i + USER_BATCH_SIZE]
+            cursor.execute(sql.replace('{users}', ", ".join(["%s"] * len(batch))),
+                    [len(maxima)] + batch)
+            for user_id, score in cursor.fetchall():
+                scores[user_id] = float(score)
+    return scores
+
+
+def _average_weights(groups):
+    """``{question_pk: weight}`` such that summing ``score * weight`` over a
+    user's submissions gives the average, over ``groups`` of tags, of their
+    percent score on each group's questions (unanswered counting as zero)."""
+    weights = {}
+    for tags in groups:
+        maxima = tag_index.scored(tags)
+        for pk, max_score in maxima.items():
+            weights[pk] = weights.get(pk, 0) + 100.0 / (max_score * len(maxima) * len(groups))
+    return weights
+
+
+def _percent_bucket(percent):
+    """The whole percent a score is counted under, rounding halves up; the
+    same on both sides of a percentile lookup, whichever database built the
+    distribution.  Allows for float error in sums at exact halves."""
+    return int(math.floor(percent + 0.5 + 1e-9))
+
+
+def _score_histogram(weights, using):
+    """``{percent: users}`` counting the users with submissions to any of the
+    questions in ``weights`` by their weighted score, bucketed by
+    ``_percent_bucket``.  The database counts the users at each exact score
+    (few, as scores are made of a few answers each), not each bucket, since
+    its ROUND may round halves differently."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    question = qn(Submission._meta.get_field('question_ref').column)
+    sql = """
+        SELECT percent, COUNT(*) FROM (
+            SELECT SUM(s.%(score)s * CASE s.%(question)s %(weights)s END) AS percent
+            FROM %(submission)s s
+            WHERE s.%(question)s IN (%(questions)s)
+            GROUP BY s.%(user)s
+        ) scores
+        GROUP BY percent
+    """ % {
+        'user': qn(Submission._meta.get_field('user').column),
+        'score': qn('score'),
+        'question': question,
+        'submission': qn(Submission._meta.db_table),
+        'weights': " ".join(["WHEN %d THEN %r" % (pk, weight)
+                             for pk, weight in sorted(weights.items())]),
+        'questions': ", ".join(["%d" % pk for pk in sorted(weights)]),
+    }
+    cursor = connection.cursor()
+    cursor.execute(sql)
+    histogram = {}
+    for percent, count in cursor.fetchall():
+        bucket = _percent_bucket(percent)
+        histogram[bucket] = histogram.get(bucket, 0) + count
+    return histogram
+
+
+class ScoreDistributionManager(models.Manager):
+
+    def rebuild(self):
+        """Recompute the distributions of scores on every scored question,
+        every tag and every Sectioned Scoring plugin's overall score."""
+        histograms = {}
+        def add(kind, key, histogram):
+            totals = histograms.setdefault((kind, key), {})
+            for percent, count in histogram.items():
+                totals[percent] = totals.get(percent, 0) + count
+        entries = dict((e.pk, e) for e in catalog.entries().values() if e.max_score)
+        tags = sorted(tag_index.index())
+        scorings = [(scoring.pk, [[section.tag] for section in scoring.sections.all()])
+                    for scoring in SectionedScoring.objects.all()]
+        for alias in shards():
+            # each user's submissions are all on one shard, so the shards'
+            # histograms just add up
+            alias = alias or router.db_for_read(Submission)
+            submissions = Submission.objects.using(alias).filter(question_ref__isnull=False)
+            for row in submissions.order_by().values('question_ref', 'score').annotate(
+                    count=Count('pk')):
+                entry = entries.get(row['question_ref'])
+                if entry is not None:
+                    percent = _percent_bucket(entry.percent_score(row['score']))
+                    add(self.model.QUESTION, entry.slug, {percent: row['count']})
+            for tag in tags:
+                weights = _average_weights([[tag]])
+                if weights:
+                    add(self.model.TAG, tag, _score_histogram(weights, alias))
+            for pk, groups in scorings:
+                weights = _average_weights(groups)
+                if weights:
+                    add(self.model.SCORING, str(pk), _score_histogram(weights, alias))
+
+        rows = []
+        for (kind, key), histogram in histograms.items():
+            # a row at 0 means every score finds a row at or below it
+            histogram.setdefault(0, 0)
+            total, below = sum(histogram.values()), 0
+            for percent, count in sorted(histogram.items()):
+                rows.append((kind, key, percent, count, below, total))
+                below += count
+        using = router.db_for_write(self.model)
+        with transaction.commit_on_success(using=using):
+            self.using(using).all().delete()
+            _insert_many(self.model, ['kind', 'key', 'percent', 'count', 'below', 'total'],
+                    rows, using)
+
+    def percentile(self, kind, key, score, using=None):
+        """The percentage of respondents whose ``kind`` of score ``key`` is a
+        lower whole percent than ``score``, from one indexed lookup, or None
+        if there's no distribution for it."""
+        percent = _percent_bucket(score)
+        rows = list(self.using(using or router.db_for_read(self.model)).filter(
+                kind=kind, key=key, percent__lte=percent).order_by('-percent')[:1])
+        if not rows:
+            return None
+        row = rows[0]
+        below = row.below + (row.count if row.percent < percent else 0)
+        return 100.0 * below / row.total
+
+
+class ScoreDistribution(models.Model):
+    """How many respondents scored each whole percent on a question (keyed
+    by slug), a tag or a Sectioned Scoring plugin's overall score (keyed by
+    plugin id), as of the last ``refresh_score_distributions``.
+
+    Respondents are the users who answered any of the questions involved.
+    There is a row for 0 and for each percent someone scored; ``below`` is
+    the number of respondents who scored less, and ``total`` all of them.
+    """
+    QUESTION = 'question'
+    TAG = 'tag'
+    SCORING = 'scoring'
+    KIND_CHOICES = (
+        (QUESTION, 'Question'),
+        (TAG, 'Tag'),
+        (SCORING, 'Sectioned Scoring'),
+    )
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    key = models.CharField(max_length=255)
+    percent = models.IntegerField()
+    count = models.IntegerField(default=0)
+    below = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+
+    objects = ScoreDistributionManager()
 
+    class Meta:
+        unique_together = ('kind', 'key', 'percent')
+
+    def __unicode__(self):
+        return u"%s %s distribution at %d%%" % (self.kind, self.key, self.percent)
+
+
+def remember_question_slug(sender, instance, raw=False, **kwargs):
+    """Note the slug a question was saved with, for ``sync_submission_slugs``."""
+    instance._saq_saved_slug = None
+    if not raw and instance.pk is not None:
+        saved = list(Question.objects.filter(pk=instance.pk).values_list('slug', flat=True))
+        instance._saq_saved_slug = saved[0] if saved else None
+
+pre_save.connect(remember_question_slug, sender=Question)
+
+def sync_submission_slugs(sender, instance, created=False, raw=False, **kwargs):
+    """Carry a question's new slug over to its submissions on every shard,
+    and link any unlinked submissions to a new (or newly loaded) question,
+    or one that has taken a new slug."""
+    saved_slug = getattr(instance, '_saq_saved_slug', None)
+    renamed = not raw and saved_slug is not None and saved_slug != instance.slug
+    if not (created or raw or renamed):
+        return
+    changed = 0
+    for alias in shards():
+        submissions = Submission.objects.using(alias)
+        if renamed:
+            changed += submissions.filter(question_ref=instance.pk).exclude(
+                    question=instance.slug).update(question=instance.slug)
+        submissions.filter(question=instance.slug, question_ref__isnull=True).update(
+                question_ref=instance.pk)
+    if changed:
+        submission_cache.invalidate()
+
+post_save.connect(sync_submission_slugs, sender=Question)
+
+def link_submission_question(sender, instance, raw=False, **kwargs):
+    """Link submissions saved one at a time (rather than through
+    ``upsert``) to their questions."""
+    if instance.question_ref_id is None:
+        entry = catalog.get(instance.question)
+        if entry is not None:
+            instance.question_ref_id = entry.pk
+
+pre_save.connect(link_submission_question, sender=Submission)
+
+# The sharded models' foreign keys into the default database don't cascade
+# (the collector would look for them in the default database); these clean
+# up after deleted users, questions and answers on the shards instead.
+def delete_user_submissions(sender, instance, **kwargs):
+    alias = shard_for_user(instance.pk)
+    Submission.objects.using(alias).filter(user=instance.pk).delete()
+    TagScoreRollup.objects.using(alias).filter(user=instance.pk).delete()
+    ProgressCounter.objects.using(alias).filter(user=instance.pk).delete()
+
+pre_delete.connect(delete_user_submissions, sender=User)
+
+def unlink_question_submissions(sender, instance, **kwargs):
+    for alias in shards():
+        Submission.objects.using(alias).filter(question_ref=instance.pk).update(
+                question_ref=None)
+
+pre_delete.connect(unlink_question_submissions, sender=Question)
+
+def delete_answer_choices(sender, instance, **kwargs):
+    for alias in shards():
+        SubmissionChoice.objects.using(alias).filter(answer=instance.pk).delete()
+
+pre_delete.connect(delete_answer_choices, sender=Answer)
+
+
+for model in (Question, Answer, GroupedAnswer, Tag):
+    post_save.connect(catalog.invalidate, sender=model)
+    post_delete.connect(catalog.invalidate, sender=model)
+
+def invalidate_catalog_tags(sender, instance, **kwargs):
+    """Rebuild the catalog when a question is tagged or untagged, but not
+    when anything else is."""
+    if instance.content_type_id == ContentType.objects.get_for_model(Question).pk:
+        catalog.invalidate()
+
+for signal in (post_save, post_delete):
+    signal.connect(invalidate_catalog_tags, sender=Question._meta.get_field('tags').through)
+
+def invalidate_cached_submissions(sender, instance, **kwargs):
+    submission_cache.invalidate_user(instance.user_id)
+
+post_save.connect(invalidate_cached_submissions, sender=Submission)
+post_delete.connect(invalidate_cached_submissions, sender=Submission)
+
+for model in (Question, CMSPlugin):
+    post_save.connect(tree_index.invalidate, sender=model)
+    post_delete.connect(tree_index.invalidate, sender=model)
+post_delete.connect(tree_index.invalidate, sender=Page)
+page_moved.connect(tree_index.invalidate)
+post_publish.connect(tree_index.invalidate)
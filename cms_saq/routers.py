@@ -0,0 +1,127 @@
+"""
+Optional sharding of submissions, and the tables derived from them, across
+several databases by a hash of the user id.
+
+To enable it, list the database aliases to shard across in ``SAQ_SHARDS``
+and add ``cms_saq.routers.SubmissionRouter`` to ``DATABASE_ROUTERS``.
+Questions, answers, tags and users stay in the default database.  Queries
+about one user go to that user's shard (``shard_for_user``); queries across
+users are run against each of ``shards()`` in turn.
+
+Independently of sharding, ``SAQ_READ_DATABASES`` maps database aliases to
+read replicas of them.  The read-only views, plugins and template tags read
+from the replica (``read_database``), except for a user who has submitted
+answers in the last ``SAQ_READ_STICKY_SECONDS``, whose reads stay on the
+primary so they see their own answers.  Everything else uses the primary.
+"""
+import time
+import zlib
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+SHARDED_MODELS = ('submission', 'submissionchoice', 'tagscorerollup', 'progresscounter')
+
+
+def is_sharded(model):
+    opts = model._meta
+    return opts.app_label == 'cms_saq' and opts.module_name in SHARDED_MODELS
+
+
+def shard_for_user(user):
+    """The alias of the shard holding the submissions of ``user`` (a user or
+    a user id), or None when not sharding."""
+    shards = getattr(settings, 'SAQ_SHARDS', None)
+    if not shards:
+        return None
+    user_id = getattr(user, 'pk', user)
+    return shards[(zlib.crc32(str(user_id)) & 0xffffffff) % len(shards)]
+
+
+def shards():
+    """Every shard alias, or ``[None]`` (leaving the choice to the routers)
+    when not sharding."""
+    return list(getattr(settings, 'SAQ_SHARDS', None) or [None])
+
+
+def group_by_shard(user_ids):
+    """Split ``user_ids`` into ``{alias: [user_id, ...]}``."""
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_for_user(user_id), []).append(user_id)
+    return groups
+
+
+STICKY_SESSION_KEY = '_saq_read_primary_until'
+
+
+def replicas():
+    """``{primary alias: replica alias}``."""
+    return getattr(settings, 'SAQ_READ_DATABASES', None) or {}
+
+
+def stick_to_primary(request):
+    """Keep ``request``'s session reading from the primary for the next
+    ``SAQ_READ_STICKY_SECONDS`` (default 15), after it has written."""
+    session = getattr(request, 'session', None)
+    if replicas() and session is not None:
+        session[STICKY_SESSION_KEY] = time.time() + getattr(
+                settings, 'SAQ_READ_STICKY_SECONDS', 15)
+
+
+def read_database(request, alias=None):
+    """The alias to read from, for ``request``, data whose primary is
+    ``alias`` (None being the default database): its replica, if it has one
+    and the request's session hasn't written recently, or else ``alias``."""
+    replica = replicas().get(alias or DEFAULT_DB_ALIAS)
+    if replica is None:
+        return alias
+    session = getattr(request, 'session', None)
+    if session is not None and session.get(STICKY_SESSION_KEY, 0) > time.time():
+        return alias
+    return replica
+
+
+class SubmissionRouter(object):
+    """Routes the sharded SAQ models to the shard of the user they belong to,
+    where that can be told from the instance hint, and keeps everything else
+    those models refer to in the default database."""
+
+    def _db(self, model, instance):
+        if instance is None:
+            return None
+        if is_sharded(model):
+            if is_sharded(type(instance)):
+                return instance._state.db or shard_for_user(getattr(instance, 'user_id', None))
+            if instance._meta.app_label == 'auth' and instance._meta.module_name == 'user':
+                return shard_for_user(instance.pk)
+        elif is_sharded(type(instance)):
+            # e.g. a submission's user or question
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def db_for_read(self, model, **hints):
+        if not getattr(settings, 'SAQ_SHARDS', None):
+            return None
+        return self._db(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        db = self.db_for_read(model, **hints)
+        if db is None and instance is not None:
+            db = instance._state.db
+        primaries = dict((replica, primary) for primary, replica in replicas().items())
+        return primaries.get(db, db)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded(type(obj1)) or is_sharded(type(obj2)):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        shards = getattr(settings, 'SAQ_SHARDS', None)
+        if shards and is_sharded(model):
+            # the default database keeps empty tables, for deletes of users,
+            # questions and answers to look in
+            return db in shards or db == DEFAULT_DB_ALIAS
+        return None
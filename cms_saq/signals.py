@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+# Sent by ``Submission.objects.save_batch`` inside the transaction that wrote
+# the submissions, so receivers can keep derived tables in step.
+# ``submissions`` is the list of ``Submission`` instances written (upserted,
+# so they carry no primary keys) and ``previous`` maps each question slug
+# that already had an answer to its old ``(answer, score)``.
+submissions_saved = Signal(providing_args=['user', 'submissions', 'previous', 'using'])
@@ -1,47 +1,75 @@
 from django import template
 
-from cms_saq.models import Question, Answer, Submission, aggregate_score_for_user_by_tags
+from cms_saq.catalog import catalog
+from cms_saq.loader import get_loader
+from cms_saq.models import ScoreDistribution, aggregate_score_for_user_by_tags
+from cms_saq.routers import read_database, shard_for_user
 
 register = template.Library()
 
 @register.simple_tag(takes_context=True)
 def saq_percent_score(context, question_slug):
     """Get a percentage score for a single question."""
-    user = getattr(context['request'], 'user', None)
-    try:
-        question = Question.objects.get(slug=question_slug)
-    except Question.DoesNotExist:
+    question = catalog.get(question_slug)
+    if question is None or not question.max_score:
         return 0
-    return int(round(question.percent_score_for_user(user))) or 0
+    submission = get_loader(context['request']).submission(question_slug)
+    if submission is None:
+        return 0
+    return int(round(question.percent_score(submission.score))) or 0
 
 @register.simple_tag(takes_context=True)
 def saq_aggregate_percent_score_by_tags(context, tags):
     """Get an aggregate percentage score for a questions grouped by tags."""
-    user = getattr(context['request'], 'user', None)
+    request = context['request']
+    user = getattr(request, 'user', None)
     tags = tags.split(',')
-    return int(round(aggregate_score_for_user_by_tags(user, tags)))
+    using = read_database(request, shard_for_user(user))
+    return int(round(aggregate_score_for_user_by_tags(user, tags, using)))
+
+@register.simple_tag(takes_context=True)
+def saq_percentile(context, question_slug):
+    """Get the percentage of respondents who scored less on a single
+    question, or nothing if the user hasn't answered it."""
+    question = catalog.get(question_slug)
+    if question is None or not question.max_score:
+        return ""
+    submission = get_loader(context['request']).submission(question_slug)
+    if submission is None:
+        return ""
+    percentile = ScoreDistribution.objects.percentile(ScoreDistribution.QUESTION,
+            question_slug, question.percent_score(submission.score),
+            read_database(context['request']))
+    return "" if percentile is None else int(round(percentile))
+
+@register.simple_tag(takes_context=True)
+def saq_percentile_by_tag(context, tag):
+    """Get the percentage of respondents with a lower aggregate percentage
+    score for the questions with a tag."""
+    request = context['request']
+    user = getattr(request, 'user', None)
+    score = aggregate_score_for_user_by_tags(user, [tag],
+            read_database(request, shard_for_user(user)))
+    percentile = ScoreDistribution.objects.percentile(ScoreDistribution.TAG, tag, score,
+            read_database(request))
+    return "" if percentile is None else int(round(percentile))
 
 @register.simple_tag(takes_context=True)
 def saq_raw_answer(context, question_slug):
     """Returns raw answer data -- use this to get answers to free-text questions."""
-    user = getattr(context['request'], 'user', None)
-    try:
-        submission = Submission.objects.get(question=question_slug, user=user)
-    except Submission.DoesNotExist:
+    submission = get_loader(context['request']).submission(question_slug)
+    if submission is None:
         return ""
     return submission.answer
 
 @register.simple_tag(takes_context=True)
 def saq_nice_answer(context, question_slug):
     """Returns 'nice' answer text (looks up titles from Answer objects)."""
-    user = getattr(context['request'], 'user', None)
-    try:
-        submission = Submission.objects.get(question=question_slug, user=user)
-    except Submission.DoesNotExist:
+    submission = get_loader(context['request']).submission(question_slug)
+    if submission is None:
         return ""
-    try:
-        answer = Answer.objects.get(question__slug=question_slug, slug=submission.answer)
-    except Answer.DoesNotExist:
+    question = catalog.get(question_slug)
+    if question is None:
         return ""
-    return answer.title
+    return question.titles.get(submission.answer, "")
 
@@ -5,14 +5,43 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import csv
+import datetime
+import gzip
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connections, reset_queries, router
 from django.test import TestCase
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.test.client import Client, RequestFactory
-from django.utils import simplejson
+from django.utils import simplejson, unittest
 from django.template import Template, RequestContext
+from django.template.loader import render_to_string
+
+from cms.models import Placeholder
+from taggit.models import Tag, TaggedItem
 
-from cms_saq.models import Submission, Question
+from cms_saq.catalog import TagIndex, catalog, submission_cache, tag_index, tree_index
+from cms_saq.loader import get_loader
+from cms_saq.routers import STICKY_SESSION_KEY, SubmissionRouter, shard_for_user
+from cms_saq.models import Answer, Submission, SubmissionChoice, Question, TagScoreRollup, \
+        ProgressCounter, ScoreDistribution, aggregate_score_for_user_by_questions, \
+        aggregate_score_for_user_by_tags, aggregate_scores_for_users_by_tags
+
+try:
+    import numpy
+    from cms_saq import cohort
+    from cms_saq.cohort import CohortScores, ScoreMatrix, update_score_matrix
+except ImportError:  # NumPy isn't installed
+    CohortScores = None
 
 
 class SubmissionTest(TestCase):
@@ -63,9 +92,129 @@ class SubmissionTest(TestCase):
         self.assertEqual(1, Submission.objects.all().count())
         Submission.objects.get(question='favourite-team', answer='Bath RFC', score=0)
 
+    def test_submit_invalid_answer_saves_nothing(self):
+        """An invalid answer anywhere in the POST rejects the whole batch."""
+        r = self.client.post(reverse('cms_saq_submit'), {'favourite-colour': 'red', 'favourite-sport': 'tiddlywinks'})
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(0, Submission.objects.all().count())
+
+    def test_submit_to_question_this_process_missed(self):
+        """A question that the catalog doesn't know is looked for in the
+        database before being rejected."""
+        catalog.entries()
+        # as another process might, without this one hearing
+        Question.objects.filter(slug='favourite-colour').update(slug='favourite-color')
+        r = self.client.post(reverse('cms_saq_submit'), {'favourite-color': 'red'})
+        self.assertEqual(r.status_code, 200, r.content)
+        Submission.objects.get(question='favourite-color', answer='red')
+
+    def test_submit_nothing(self):
+        """Pages without questions post an empty form."""
+        r = self.client.post(reverse('cms_saq_submit'), {})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, 'OK')
+
+
+class CatalogTest(TestCase):
+    fixtures = ['submission_test']
+
+    def test_scoring_without_queries(self):
+        """Once built, the catalog scores and validates without queries."""
+        catalog.entries()
+        with self.assertNumQueries(0):
+            question = catalog.get('sports-you-play')
+            self.assertEqual(question.score('football,rugby'), 150)
+            self.assertEqual(question.max_score, 350)
+            self.assertRaises(Answer.DoesNotExist, question.score, 'tiddlywinks')
+            self.assertEqual(catalog.get('favourite-team').max_score, None)
+
+    def test_invalidation(self):
+        """Saving answers or tags rebuilds the catalog."""
+        self.assertEqual(catalog.get('favourite-colour').max_score, 30)
+        answer = Answer.objects.get(question__slug='favourite-colour', slug='blue')
+        answer.score = 50
+        answer.save()
+        self.assertEqual(catalog.get('favourite-colour').max_score, 50)
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        self.assertEqual(catalog.get('favourite-colour').tags, frozenset(['favourites']))
+        tag = Tag.objects.get(name='favourites')
+        tag.name = 'favourite things'
+        tag.save()
+        self.assertEqual(catalog.get('favourite-colour').tags, frozenset(['favourite things']))
+
+    def test_other_tagged_models(self):
+        """Tagging something other than a question leaves the catalog be."""
+        tag = Tag.objects.create(name='favourites')
+        catalog.entries()
+        generation = catalog.generation.current()
+        TaggedItem.objects.create(tag=tag, content_type=ContentType.objects.get_for_model(User),
+                                  object_id=1)
+        self.assertEqual(catalog.generation.current(), generation)
+
+    def test_local_cache_refused(self):
+        """Other processes wouldn't see the generation change."""
+        allow = settings.SAQ_ALLOW_LOCAL_CACHE
+        settings.SAQ_ALLOW_LOCAL_CACHE = False
+        try:
+            self.assertRaises(ImproperlyConfigured, catalog.entries)
+        finally:
+            settings.SAQ_ALLOW_LOCAL_CACHE = allow
+
+    def test_generation_reads(self):
+        """Reading a seeded generation doesn't write to the cache."""
+        from cms_saq import catalog as catalog_module
+        generation = catalog.generation.current()
+        add = catalog_module.cache.add
+        catalog_module.cache.add = None
+        try:
+            self.assertEqual(catalog.generation.current(), generation)
+        finally:
+            catalog_module.cache.add = add
+
+    def test_question_missing_from_catalog(self):
+        """Questions the catalog hasn't caught up with are scored from the
+        database."""
+        question = Question.objects.get(slug='sports-you-play')
+        question.slug = 'not-in-the-catalog'
+        self.assertEqual(question.score('football,rugby'), 150)
+        self.assertRaises(Answer.DoesNotExist, question.score, 'tiddlywinks')
+        self.assertEqual(Question(slug='unsaved', question_type='F').score('hello'), 0)
+
+
+class TagIndexTest(TestCase):
+    fixtures = ['submission_test']
+
+    def setUp(self):
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-team').tags.add('favourites', 'sports')
+
+    def test_index(self):
+        self.assertEqual(tag_index.questions(['favourites', 'sports']), frozenset([
+                (1, 'favourite-colour', 30), (4, 'favourite-team', None)]))
+        self.assertEqual(tag_index.scored(['favourites']), {1: 30})
+        self.assertFalse(tag_index.overlap(['favourites', 'sports']))
+        Question.objects.get(slug='favourite-colour').tags.add('sports')
+        self.assertTrue(tag_index.overlap(['favourites', 'sports']))
+
+    def test_shared_through_cache(self):
+        """Another process finds the index in the Django cache."""
+        tag_index.index()
+        with self.assertNumQueries(0):
+            self.assertEqual(TagIndex(catalog).scored(['favourites']), {1: 30})
+
+    def test_invalidation(self):
+        tag_index.index()
+        Question.objects.get(slug='favourite-colour').tags.remove('favourites')
+        self.assertEqual(tag_index.scored(['favourites']), {})
+        f = tempfile.NamedTemporaryFile()
+        f.write(simplejson.dumps({'favourite-sport': ['favourites']}))
+        f.flush()
+        call_command('load_question_tags', f.name, stdout=StringIO())
+        self.assertEqual(tag_index.scored(['favourites']), {2: 60})
+
 
 class ScoresTest(TestCase):
-    fixtures = ['scores_test']
+    fixtures = ['scores_test', 'submission_test']
 
     def setUp(self):
         self.client = Client()
@@ -118,6 +267,961 @@ class ScoresTest(TestCase):
             }
         })
 
+    def test_tag_scores(self):
+        """Tag and overall percent scores come in the same response."""
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-sport').tags.add('favourites', 'sports')
+        Question.objects.get(slug='sports-you-play').tags.add('sports')
+        self.client.login(username="uncle_bill", password="password")
+        resp = self.client.get(reverse('cms_saq_scores'),
+                {'q': ['favourite-colour'], 'tag': ['favourites', 'sports', 'favourites,sports']})
+        data = simplejson.loads(resp.content)
+        self.assertEqual(data['submissions'], {'favourite-colour': {'answer': 'red', 'score': 10}})
+        bill = User.objects.get(username='uncle_bill')
+        for tag in ('favourites', 'sports', 'favourites,sports'):
+            self.assertAlmostEqual(data['tags'][tag],
+                    aggregate_score_for_user_by_tags(bill, tag.split(',')))
+        self.assertAlmostEqual(data['tags']['sports'], 100.0 * (40.0 / 60 + 1) / 2)
+        self.assertAlmostEqual(data['overall'], sum(data['tags'].values()) / 3)
+
+        resp = self.client.get(reverse('cms_saq_scores'), {'tag': 'sports'})
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(reverse('cms_saq_scores'))
+        self.assertEqual(resp.status_code, 400)
+
+    def test_conditional_get(self):
+        """Polls with a current ETag get a 304 without reading submissions."""
+        self.client.login(username="uncle_bill", password="password")
+        url = reverse('cms_saq_scores')
+        resp = self.client.get(url, {'q': self.questions})
+        etag = resp['ETag']
+        # Last-Modified would miss changes to the questions
+        self.assertFalse(resp.has_header('Last-Modified'))
+        self.assertTrue('no-cache' in resp['Cache-Control'])
+
+        connection = connections['default']
+        connection.use_debug_cursor = True
+        try:
+            del connection.queries[:]
+            resp = self.client.get(url, {'q': self.questions}, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(resp.status_code, 304)
+            self.assertTrue('no-cache' in resp['Cache-Control'])
+            self.assertFalse([q for q in connection.queries
+                              if Submission._meta.db_table in q['sql']])
+        finally:
+            connection.use_debug_cursor = False
+
+        self.client.post(reverse('cms_saq_submit'), {'favourite-colour': 'blue'})
+        resp = self.client.get(url, {'q': self.questions}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+        data = simplejson.loads(resp.content)
+        self.assertEqual(data['submissions']['favourite-colour']['answer'], 'blue')
+
+        etag = resp['ETag']
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        resp = self.client.get(url, {'q': self.questions, 'tag': 'favourites'},
+                               HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+
+
+class BulkScoresTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def setUp(self):
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-sport').tags.add('favourites')
+        User.objects.create_user('coach', 'coach@example.com', 'password')
+        User.objects.filter(username='coach').update(is_staff=True)
+        self.client = Client()
+        self.client.login(username='coach', password='password')
+
+    def get(self, **params):
+        resp = self.client.get(reverse('cms_saq_bulk_scores'), params)
+        # the content is streamed, so can only be read once
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        return [simplejson.loads(line) for line in resp.content.splitlines()]
+
+    def test_scores(self):
+        lines = self.get(q='favourite-team', tag='favourites')
+        self.assertEqual(lines[-1], {'next': None})
+        self.assertEqual([line['user_id'] for line in lines[:-1]], [1, 2])
+        bill = lines[0]
+        self.assertEqual(bill['submissions']['favourite-colour'],
+                         {'answer': 'red', 'score': 10, 'percent': 100.0 * 10 / 30})
+        self.assertEqual(lines[1]['submissions']['favourite-team']['percent'], None)
+        self.assertAlmostEqual(bill['tags']['favourites'],
+                aggregate_scores_for_users_by_tags([1], ['favourites'])[1])
+
+    def test_tags(self):
+        Question.objects.get(slug='favourite-team').tags.add('sports')
+        lines = self.get(tag=['favourites', 'favourites,sports'])
+        self.assertEqual(sorted(lines[0]['submissions']), ['favourite-colour', 'favourite-sport'])
+        self.assertEqual(sorted(lines[0]['tags']), ['favourites', 'favourites,sports'])
+        self.assertAlmostEqual(lines[0]['tags']['favourites,sports'],
+                aggregate_scores_for_users_by_tags([1], ['favourites', 'sports'])[1])
+
+    def test_pages(self):
+        lines = self.get(q=['favourite-colour', 'sports-you-play'], limit=1)
+        self.assertEqual([line.get('user_id') for line in lines], [1, None])
+        self.assertEqual(lines[-1], {'next': 1})
+        lines = self.get(q=['favourite-colour', 'sports-you-play'], limit=1, after=1)
+        self.assertEqual([line.get('user_id') for line in lines], [2, None])
+        lines = self.get(q=['favourite-colour', 'sports-you-play'], limit=1, after=2)
+        self.assertEqual(lines, [{'next': None}])
+        lines = self.get(q=['favourite-colour'], **{'from': 2, 'to': 2})
+        self.assertEqual([line.get('user_id') for line in lines], [2, None])
+
+    def test_row_cap(self):
+        """Pages stop short rather than fetch more than BULK_SCORES_MAX_ROWS
+        rows from a shard."""
+        from cms_saq import views
+        max_rows = views.BULK_SCORES_MAX_ROWS
+        views.BULK_SCORES_MAX_ROWS = 1
+        try:
+            lines = self.get(q=['favourite-colour', 'sports-you-play'])
+            self.assertEqual([line.get('user_id') for line in lines], [1, None])
+            self.assertEqual(lines[-1], {'next': 1})
+            lines = self.get(q=['favourite-colour', 'sports-you-play'], after=1)
+            self.assertEqual([line.get('user_id') for line in lines], [2, None])
+        finally:
+            views.BULK_SCORES_MAX_ROWS = max_rows
+
+    def test_cut_short(self):
+        """A page stops before users a shard's LIMIT may have cut off."""
+        from cms_saq.views import _Rows, _bulk_scores_lines
+        entries = catalog.entries()
+        questions = dict((entries[slug].pk, entries[slug])
+                         for slug in ('favourite-colour', 'favourite-sport'))
+        # shard a reached its limit of 4 rows partway through user 5
+        shard_a = _Rows(iter([(1, 1, 'red', 10), (1, 2, 'football', 40),
+                              (3, 1, 'red', 10), (5, 1, 'red', 10)]), 4)
+        shard_b = _Rows(iter([(2, 1, 'red', 10), (4, 1, 'red', 10), (6, 1, 'red', 10)]), 4)
+        lines = [simplejson.loads(line) for line in
+                 _bulk_scores_lines([shard_a, shard_b], questions, [], 10)]
+        self.assertEqual([line.get('user_id') for line in lines], [1, 2, 3, 4, None])
+        self.assertEqual(lines[-1], {'next': 4})
+
+    def test_staff_only(self):
+        self.client.login(username='uncle_bill', password='password')
+        resp = self.client.get(reverse('cms_saq_bulk_scores'), {'q': 'favourite-colour'})
+        self.assertEqual(resp.status_code, 302)
+
+
+class UpsertTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def test_upsert_batch(self):
+        """New rows are inserted and existing rows updated in one statement."""
+        bill = User.objects.get(username='uncle_bill')
+        catalog.entries()
+        with self.assertNumQueries(1):
+            Submission.objects.upsert([
+                Submission(user=bill, question='favourite-colour', answer='green', score=20),
+                Submission(user=bill, question='favourite-team', answer='Bath RFC', score=0),
+            ])
+        self.assertEqual(4, Submission.objects.filter(user=bill).count())
+        Submission.objects.get(user=bill, question='favourite-colour', answer='green', score=20)
+        Submission.objects.get(user=bill, question='favourite-team', answer='Bath RFC')
+
+    def test_upsert_fallback(self):
+        """Backends without native upsert fall back to update-then-create."""
+        bill = User.objects.get(username='uncle_bill')
+        manager = Submission.objects
+        manager._update_or_create(Submission(user=bill, question='favourite-colour', answer='green', score=20), 'default')
+        manager._update_or_create(Submission(user=bill, question='favourite-team', answer='Bath RFC', score=0), 'default')
+        self.assertEqual(4, Submission.objects.filter(user=bill).count())
+        Submission.objects.get(user=bill, question='favourite-colour', answer='green', score=20)
+
+    def test_upsert_duplicates(self):
+        """The last of several submissions to one question wins."""
+        bill = User.objects.get(username='uncle_bill')
+        Submission.objects.upsert([
+            Submission(user=bill, question='favourite-team', answer='Bath RFC', score=0),
+            Submission(user=bill, question='favourite-team', answer='Leicester', score=0),
+        ])
+        Submission.objects.get(user=bill, question='favourite-team', answer='Leicester')
+
+    def test_upsert_old_sqlite(self):
+        """SQLite before 3.24 has no ON CONFLICT DO UPDATE."""
+        # the library the backend uses, which may not be the stdlib's
+        from django.db.backends.sqlite3.base import Database
+        version = Database.sqlite_version_info
+        Database.sqlite_version_info = (3, 23, 1)
+        try:
+            bill = User.objects.get(username='uncle_bill')
+            Submission.objects.upsert([
+                Submission(user=bill, question='favourite-colour', answer='green', score=20),
+                Submission(user=bill, question='favourite-team', answer='Bath RFC', score=0),
+            ])
+        finally:
+            Database.sqlite_version_info = version
+        self.assertEqual(4, Submission.objects.filter(user=bill).count())
+        Submission.objects.get(user=bill, question='favourite-colour', answer='green', score=20)
+
+    def test_upsert_after_rename(self):
+        """A renamed question's submissions clash on ``(question, user)``
+        as well as ``(user, question_ref)``, so are updated in place."""
+        bill = User.objects.get(username='uncle_bill')
+        colour = Question.objects.get(slug='favourite-colour')
+        colour.slug = 'favourite-color'
+        colour.save()
+        Submission.objects.upsert([
+            Submission(user=bill, question='favourite-color', answer='green', score=20)])
+        submission = Submission.objects.get(user=bill, question_ref=colour)
+        self.assertEqual((submission.question, submission.answer), ('favourite-color', 'green'))
+        self.assertEqual(3, Submission.objects.filter(user=bill).count())
+
+
+class BulkWriteTest(TestCase):
+
+    def test_insert_many(self):
+        """Rows are inserted several to a statement."""
+        from cms_saq.models import _insert_many
+        rows = [('tag', 'sport', percent, 1, 0, 1) for percent in range(101)]
+        rows += [('tag', 'colour', percent, 1, 0, 1) for percent in range(101)]
+        with self.assertNumQueries(2):
+            _insert_many(ScoreDistribution,
+                         ['kind', 'key', 'percent', 'count', 'below', 'total'], rows, 'default')
+        self.assertEqual(ScoreDistribution.objects.count(), 202)
+        self.assertEqual(ScoreDistribution.objects.filter(key='colour', percent=100).count(), 1)
+
+    def test_delete_many(self):
+        """Rows are deleted several to a statement."""
+        from cms_saq.models import _delete_many
+        for percent in range(101):
+            ScoreDistribution.objects.create(kind='tag', key='sport', percent=percent,
+                                             count=1, below=0, total=1)
+        pks = list(ScoreDistribution.objects.values_list('pk', flat=True))
+        with self.assertNumQueries(1):
+            _delete_many(ScoreDistribution, pks[1:], 'default')
+        self.assertEqual(list(ScoreDistribution.objects.values_list('pk', flat=True)), pks[:1])
+
+
+class QuestionRefTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def test_backfill_and_rename(self):
+        Submission.objects.create(user_id=1, question='no-such-question', answer='', score=0)
+        # as submissions were before question_ref
+        Submission.objects.update(question_ref=None)
+        out = StringIO()
+        call_command('backfill_submission_questions', chunk_size=4, stdout=out)
+        self.assertTrue("Linked 6 submissions, 1 without a question" in out.getvalue(),
+                out.getvalue())
+        colour = Question.objects.get(slug='favourite-colour')
+        self.assertEqual(colour.submissions.count(), 2)
+
+        colour.slug = 'favourite-color'
+        colour.save()
+        self.assertEqual(Submission.objects.filter(question='favourite-color').count(), 2)
+
+    def test_save_without_rename(self):
+        """Saving a question without changing its slug leaves submissions be."""
+        colour = Question.objects.get(slug='favourite-colour')
+        colour.label = 'Colour'
+        connection = connections['default']
+        connection.use_debug_cursor = True
+        reset_queries()
+        try:
+            colour.save()
+            queries = [q['sql'] for q in connection.queries]
+        finally:
+            connection.use_debug_cursor = None
+        self.assertFalse([sql for sql in queries if Submission._meta.db_table in sql], queries)
+
+    def test_linked_on_save(self):
+        """Submissions are linked whichever of them and their question is
+        saved (or loaded) first."""
+        from cms.api import add_plugin
+        self.assertEqual(Submission.objects.filter(question_ref__isnull=True).count(), 0)
+        submission = Submission.objects.create(user_id=1, question='favourite-food',
+                answer='Chips', score=0)
+        self.assertEqual(submission.question_ref_id, None)
+        question = add_plugin(Placeholder.objects.create(slot='main'),
+                'FreeTextQuestionPlugin', 'en', slug='favourite-food', question_type='F')
+        self.assertEqual(Submission.objects.get(pk=submission.pk).question_ref_id, question.pk)
+        submission = Submission.objects.create(user_id=2, question='favourite-food',
+                answer='Pie', score=0)
+        self.assertEqual(submission.question_ref_id, question.pk)
+
+    def test_linked_on_submit(self):
+        bill = User.objects.get(username='uncle_bill')
+        Submission.objects.save_batch(bill, [
+            Submission(user=bill, question='favourite-team', answer='Bath RFC', score=0)])
+        submission = Submission.objects.get(user=bill, question='favourite-team')
+        self.assertEqual(submission.question_ref.slug, 'favourite-team')
+
+
+class AggregateScoreTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def setUp(self):
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-sport').tags.add('favourites', 'sports')
+        Question.objects.get(slug='sports-you-play').tags.add('sports')
+        Question.objects.get(slug='favourite-team').tags.add('sports')
+
+    def test_matches_per_question_scoring(self):
+        """Set-based scores match averaging each question's percent score."""
+        users = list(User.objects.all())
+        for tags in (['favourites'], ['sports'], ['favourites', 'sports'], ['nonsense']):
+            questions = Question.objects.filter(tags__name__in=tags).distinct()
+            expected = dict((u.pk, aggregate_score_for_user_by_questions(u, questions))
+                    for u in users)
+            scores = aggregate_scores_for_users_by_tags(users, tags)
+            self.assertEqual(sorted(scores), sorted(expected))
+            for user_id, score in scores.items():
+                self.assertAlmostEqual(score, expected[user_id])
+
+    def test_query_count(self):
+        aggregate_scores_for_users_by_tags([1], ['favourites'])
+        with self.assertNumQueries(1):
+            aggregate_scores_for_users_by_tags([1, 2], ['favourites', 'sports'])
+
+
+class TagScoreRollupTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def setUp(self):
+        self._rollups = getattr(settings, 'SAQ_SCORE_ROLLUPS', False)
+        settings.SAQ_SCORE_ROLLUPS = True
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-sport').tags.add('favourites', 'sports')
+        Question.objects.get(slug='sports-you-play').tags.add('sports')
+        self.bill = User.objects.get(username='uncle_bill')
+        call_command('rebuild_score_rollups', chunk_size=1, stdout=StringIO())
+
+    def tearDown(self):
+        settings.SAQ_SCORE_ROLLUPS = self._rollups
+
+    def _live_score(self, tags):
+        settings.SAQ_SCORE_ROLLUPS = False
+        try:
+            return aggregate_score_for_user_by_tags(self.bill, tags)
+        finally:
+            settings.SAQ_SCORE_ROLLUPS = True
+
+    def test_rebuild(self):
+        rollup = TagScoreRollup.objects.get(user=self.bill, tag='favourites')
+        self.assertEqual(rollup.count, 2)
+        self.assertAlmostEqual(rollup.percent_sum, 100.0 / 3 + 200.0 / 3)
+
+    def test_incremental_update(self):
+        """Submissions update the rollups in step with live scoring."""
+        Submission.objects.save_batch(self.bill, [
+            Submission(user=self.bill, question='favourite-colour', answer='blue', score=30),
+            Submission(user=self.bill, question='favourite-sport', answer='cricket', score=60),
+        ])
+        rollup = TagScoreRollup.objects.get(user=self.bill, tag='favourites')
+        self.assertEqual(rollup.count, 2)
+        self.assertAlmostEqual(rollup.percent_sum, 200.0)
+        self.assertAlmostEqual(aggregate_score_for_user_by_tags(self.bill, ['favourites']),
+                self._live_score(['favourites']))
+
+    def test_first_answers_upsert_rollups(self):
+        """Rollups are created by first answers and updated by later ones,
+        with or without a native upsert."""
+        import sqlite3
+        version = sqlite3.sqlite_version_info
+        for sqlite_version in (version, (3, 23, 1)):
+            TagScoreRollup.objects.filter(user=self.bill).delete()
+            Submission.objects.filter(user=self.bill).delete()
+            sqlite3.sqlite_version_info = sqlite_version
+            try:
+                for answer, score in (('blue', 30), ('red', 10)):
+                    Submission.objects.save_batch(self.bill, [Submission(user=self.bill,
+                            question='favourite-colour', answer=answer, score=score)])
+            finally:
+                sqlite3.sqlite_version_info = version
+            rollup = TagScoreRollup.objects.get(user=self.bill, tag='favourites')
+            self.assertEqual(rollup.count, 1)
+            self.assertAlmostEqual(rollup.percent_sum, 100.0 / 3)
+
+    def test_overlapping_tags_fall_back(self):
+        """Tags sharing questions are scored live rather than from rollups."""
+        TagScoreRollup.objects.all().delete()
+        self.assertEqual(aggregate_score_for_user_by_tags(self.bill, ['sports']), 0)
+        self.assertAlmostEqual(aggregate_score_for_user_by_tags(self.bill, ['favourites', 'sports']),
+                self._live_score(['favourites', 'sports']))
+
+
+class ScoreDistributionTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def setUp(self):
+        from cms.api import add_plugin
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-sport').tags.add('favourites', 'sports')
+        Question.objects.get(slug='sports-you-play').tags.add('sports')
+        user = User.objects.create_user('cousin_ed', 'ed@example.com', 'password')
+        Submission.objects.create(user=user, question='favourite-colour', answer='green', score=20)
+        self.scoring = add_plugin(Placeholder.objects.create(slot='main'),
+                'SectionedScoringPlugin', 'en', show_percentiles=True)
+        for i, tag in enumerate(['favourites', 'sports']):
+            self.scoring.sections.create(label=tag.title(), tag=tag, order=i)
+        self.users = list(User.objects.order_by('pk'))
+        out = StringIO()
+        call_command('refresh_score_distributions', stdout=out)
+        self.assertEqual(out.getvalue(), "Refreshed 6 score distributions\n")
+
+    def _request_for_user(self, user):
+        request = RequestFactory().get('/foobar')
+        request.user = user
+        return request
+
+    def assertPercentiles(self, kind, key, scores):
+        for score in scores:
+            below = len([s for s in scores if round(s) < round(score)])
+            self.assertAlmostEqual(ScoreDistribution.objects.percentile(kind, key, score),
+                                   100.0 * below / len(scores))
+
+    def test_question(self):
+        rows = ScoreDistribution.objects.filter(kind='question', key='favourite-colour')
+        self.assertEqual([(r.percent, r.count, r.below, r.total) for r in rows.order_by('percent')],
+                         [(0, 0, 0, 3), (33, 1, 0, 3), (67, 1, 1, 3), (100, 1, 2, 3)])
+        for user, expected in zip(self.users, ['0', '67', '33']):
+            template = Template("{% load saq_tags %}{% saq_percentile \"favourite-colour\" %}")
+            self.assertEqual(template.render(RequestContext(self._request_for_user(user))),
+                             expected)
+        # a score nobody has, and no distribution at all
+        self.assertAlmostEqual(
+                ScoreDistribution.objects.percentile('question', 'favourite-colour', 80),
+                200.0 / 3)
+        self.assertEqual(ScoreDistribution.objects.percentile('question', 'nonsense', 80), None)
+
+    def test_tags(self):
+        for tag in ('favourites', 'sports'):
+            questions = tag_index.scored([tag])
+            scores = [aggregate_score_for_user_by_tags(user, [tag]) for user in self.users
+                      if Submission.objects.filter(user=user, question_ref__in=questions)]
+            self.assertPercentiles('tag', tag, scores)
+        template = Template("{% load saq_tags %}{% saq_percentile_by_tag \"favourites\" %}")
+        self.assertEqual(template.render(RequestContext(self._request_for_user(self.users[1]))),
+                         '67')
+
+    def test_half_percent(self):
+        """A score at exactly a half percent is bucketed as it is looked up,
+        so its respondents don't count as below themselves."""
+        Question.objects.get(slug='favourite-colour').tags.add('colours')
+        answer = Answer.objects.get(question__slug='favourite-colour', slug='blue')
+        answer.score = 40
+        answer.save()
+        Submission.objects.filter(question='favourite-colour', answer='green').update(score=25)
+        ScoreDistribution.objects.rebuild()
+        # 25 of 40 is 62.5%
+        rows = ScoreDistribution.objects.filter(kind='tag', key='colours')
+        self.assertEqual([(r.percent, r.count) for r in rows.order_by('percent')],
+                         [(0, 0), (25, 1), (63, 1), (75, 1)])
+        for kind, key in (('tag', 'colours'), ('question', 'favourite-colour')):
+            self.assertAlmostEqual(ScoreDistribution.objects.percentile(kind, key, 62.5),
+                                   100.0 / 3)
+
+    def test_sectioned_scoring(self):
+        from cms_saq.cms_plugins import SectionedScoringPlugin
+        overall = [self.scoring.scores_for_user(user)[1] for user in self.users]
+        self.assertPercentiles('scoring', str(self.scoring.pk), overall)
+        plugin = SectionedScoringPlugin()
+        request = self._request_for_user(self.users[1])
+        context = plugin.render(RequestContext(request), self.scoring, None)
+        self.assertEqual([percentile for label, score, percentile in context['sections']],
+                         [ScoreDistribution.objects.percentile('tag', 'favourites', 100),
+                          ScoreDistribution.objects.percentile('tag', 'sports',
+                                aggregate_score_for_user_by_tags(self.users[1], ['sports']))])
+        self.assertEqual(context['overall_percentile'], ScoreDistribution.objects.percentile(
+                'scoring', str(self.scoring.pk), overall[1]))
+        out = render_to_string(plugin.render_template, context)
+        self.assertEqual(out.count("% of respondents"), 3)
+        self.scoring.show_percentiles = False
+        context = plugin.render(RequestContext(request), self.scoring, None)
+        self.assertEqual(context['overall_percentile'], None)
+        out = render_to_string(plugin.render_template, context)
+        self.assertFalse("% of respondents" in out)
+
+
+@unittest.skipUnless(CohortScores, "needs NumPy")
+class CohortScoresTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def setUp(self):
+        from cms.api import add_plugin
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-sport').tags.add('favourites', 'sports')
+        Question.objects.get(slug='sports-you-play').tags.add('sports')
+        Question.objects.get(slug='favourite-team').tags.add('sports')
+        self.scoring = add_plugin(Placeholder.objects.create(slot='main'),
+                'SectionedScoringPlugin', 'en')
+        for i, tag in enumerate(['favourites', 'sports', 'nonsense']):
+            self.scoring.sections.create(label=tag.title(), tag=tag, order=i)
+        User.objects.create_user('no_answers', 'no_answers@example.com', 'password')
+        self.users = list(User.objects.order_by('pk'))
+
+    def test_matches_per_user_scoring(self):
+        cohort = CohortScores(self.users)
+        self.assertEqual(cohort.percent_scores.shape, (3, 3))
+        for tags in (['favourites'], ['sports'], ['favourites', 'sports'], ['nonsense']):
+            scores = cohort.tag_scores(tags)
+            for i, user in enumerate(self.users):
+                self.assertAlmostEqual(scores[i], aggregate_score_for_user_by_tags(user, tags))
+        for user in self.users:
+            expected_sections, expected_overall = self.scoring.scores_for_user(user)
+            sections, overall = cohort.scores_for_user(self.scoring, user)
+            self.assertEqual([label for label, score in sections],
+                             [label for label, score in expected_sections])
+            for (label, score), (_, expected) in zip(sections, expected_sections):
+                self.assertAlmostEqual(score, expected)
+            self.assertAlmostEqual(overall, expected_overall)
+
+    def test_query_count(self):
+        catalog.entries()
+        tag_index.index()
+        with self.assertNumQueries(1):
+            cohort = CohortScores(self.users)
+        self.assertRaises(KeyError, cohort.user_index, 1000)
+
+
+@unittest.skipUnless(CohortScores, "needs NumPy")
+class ScoreMatrixTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for submission in Submission.objects.all():
+            Submission.objects.filter(pk=submission.pk).update(
+                    modified=datetime.datetime(2012, 1, submission.pk))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def assertMatrix(self, matrix):
+        expected = dict(((s.user_id, s.question), s.score) for s in Submission.objects.all())
+        for user_id in matrix.user_ids:
+            row = matrix.row(user_id)
+            for slug in matrix.slugs:
+                score = row[matrix.columns[slug]]
+                if (user_id, slug) in expected:
+                    self.assertEqual(score, expected[(user_id, slug)])
+                else:
+                    self.assertTrue(numpy.isnan(score))
+
+    def test_build(self):
+        out = StringIO()
+        call_command('update_score_matrix', self.path, stdout=out)
+        self.assertEqual(out.getvalue(),
+                "Applied 6 submissions; the matrix has 2 users and 4 questions\n")
+        matrix = ScoreMatrix.open(self.path)
+        self.assertEqual(list(matrix.user_ids), [1, 2])
+        self.assertEqual(matrix.watermark, datetime.datetime(2012, 1, 6))
+        self.assertFalse(matrix.scores.flags.writeable)
+        self.assertMatrix(matrix)
+        self.assertEqual(list(matrix.column('favourite-colour')), [10, 30])
+
+    def test_incremental_update(self):
+        update_score_matrix(self.path)
+        user = User.objects.create_user('new_user', 'new_user@example.com', 'password')
+        Submission.objects.create(user=user, question='favourite-colour', answer='green', score=20)
+        Submission.objects.filter(pk=1).update(score=30, modified=datetime.datetime.now())
+        applied, matrix = update_score_matrix(self.path, overlap=0)
+        # the new and changed submissions, and the one at the watermark
+        self.assertEqual(applied, 3)
+        self.assertEqual(list(matrix.user_ids), [1, 2, user.pk])
+        self.assertMatrix(matrix)
+        applied, matrix = update_score_matrix(self.path, rebuild=True)
+        self.assertEqual(applied, 7)
+        self.assertMatrix(matrix)
+
+    def test_grows(self):
+        rows, columns = cohort.MATRIX_ROWS, cohort.MATRIX_COLUMNS
+        cohort.MATRIX_ROWS, cohort.MATRIX_COLUMNS = 1, 1
+        try:
+            applied, matrix = update_score_matrix(self.path, chunk_size=1)
+        finally:
+            cohort.MATRIX_ROWS, cohort.MATRIX_COLUMNS = rows, columns
+        self.assertEqual(applied, 6)
+        self.assertEqual(matrix._matrix.shape, (2, 4))
+        self.assertMatrix(matrix)
+
+    def test_cohort_scores(self):
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-sport').tags.add('favourites', 'sports')
+        update_score_matrix(self.path)
+        from_matrix = CohortScores.from_matrix(ScoreMatrix.open(self.path))
+        from_database = CohortScores(User.objects.all())
+        self.assertEqual(list(from_matrix.user_ids), list(from_database.user_ids))
+        self.assertTrue((from_matrix.scores == from_database.scores).all())
+        self.assertTrue((from_matrix.tag_scores(['favourites']) ==
+                         from_database.tag_scores(['favourites'])).all())
+
+
+class SubmissionChoiceTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def choices(self, user_id, question):
+        return sorted(SubmissionChoice.objects.filter(
+                submission__user=user_id, submission__question=question
+                ).values_list('answer__slug', flat=True))
+
+    def test_backfill_and_counts(self):
+        call_command('backfill_submission_choices', chunk_size=4, stdout=StringIO())
+        self.assertEqual(self.choices(1, 'sports-you-play'), ['cricket', 'football', 'rugby'])
+        self.assertEqual(self.choices(2, 'favourite-team'), [])
+        self.assertEqual(SubmissionChoice.objects.answer_counts('favourite-sport'),
+                         {'football': 1, 'rugby': 0, 'cricket': 1})
+        self.assertEqual(SubmissionChoice.objects.answer_counts('favourite-team'), {})
+        choosing = Submission.objects.choosing('favourite-colour', 'blue')
+        self.assertEqual(list(choosing.values_list('user', flat=True)), [2])
+        self.assertEqual(Submission.objects.choosing('favourite-colour', 'nope').count(), 0)
+
+    def test_written_on_submit(self):
+        bill = User.objects.get(username='uncle_bill')
+        Submission.objects.save_batch(bill, [
+            Submission(user=bill, question='sports-you-play', answer='rugby', score=100),
+            Submission(user=bill, question='favourite-team', answer='Bath RFC', score=0),
+        ])
+        self.assertEqual(self.choices(1, 'sports-you-play'), ['rugby'])
+        Submission.objects.save_batch(bill, [
+            Submission(user=bill, question='sports-you-play', answer='football,rugby', score=150),
+        ])
+        self.assertEqual(self.choices(1, 'sports-you-play'), ['football', 'rugby'])
+        self.assertEqual(SubmissionChoice.objects.answer_counts('sports-you-play'),
+                         {'football': 1, 'rugby': 1, 'cricket': 0})
+
+
+class SubmissionCacheTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def setUp(self):
+        self.bill = User.objects.get(username='uncle_bill')
+        self.client = Client()
+        self.client.login(username='uncle_bill', password='password')
+
+    def test_loaded_once_and_reloaded_after_submit(self):
+        with self.assertNumQueries(1):
+            submissions = submission_cache.get(self.bill)
+        self.assertEqual(submissions['favourite-colour'], ('red', 10))
+        with self.assertNumQueries(0):
+            submission_cache.get(self.bill)
+        self.client.post(reverse('cms_saq_submit'), {'favourite-colour': 'blue'})
+        with self.assertNumQueries(1):
+            submissions = submission_cache.get(self.bill)
+        self.assertEqual(submissions['favourite-colour'], ('blue', 30))
+        self.assertEqual(submissions['favourite-sport'], ('football', 40))
+
+    def test_local_cache_refused(self):
+        """Other processes wouldn't see a submit bump the user's counter."""
+        allow = settings.SAQ_ALLOW_LOCAL_CACHE
+        settings.SAQ_ALLOW_LOCAL_CACHE = False
+        try:
+            self.assertRaises(ImproperlyConfigured, submission_cache.get, self.bill)
+            self.assertRaises(ImproperlyConfigured, submission_cache.invalidate_user, self.bill)
+        finally:
+            settings.SAQ_ALLOW_LOCAL_CACHE = allow
+
+    def test_read_racing_submit(self):
+        # a read that misses, then loses the race with a submit, caches
+        # what it read under a key that is no longer used
+        key = submission_cache._key(self.bill.pk)
+        self.client.post(reverse('cms_saq_submit'), {'favourite-colour': 'blue'})
+        cache.set(key, {'favourite-colour': ('red', 10)})
+        self.assertEqual(submission_cache.get(self.bill)['favourite-colour'], ('blue', 30))
+
+    def test_invalidation(self):
+        submission_cache.get(self.bill)
+        answer = Answer.objects.get(question__slug='favourite-colour', slug='red')
+        answer.score = 15
+        answer.save()
+        call_command('rescore_submissions', stdout=StringIO())
+        self.assertEqual(submission_cache.get(self.bill)['favourite-colour'], ('red', 15))
+
+        submission = Submission.objects.get(user=self.bill, question='favourite-colour')
+        submission.delete()
+        self.assertFalse('favourite-colour' in submission_cache.get(self.bill))
+
+        # a new version ignores what earlier versions cached
+        submission_cache.version += 1
+        try:
+            with self.assertNumQueries(1):
+                submission_cache.get(self.bill)
+        finally:
+            submission_cache.version -= 1
+
+
+class RescoreSubmissionsTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def test_rescore(self):
+        """Changed answer scores are applied to existing submissions."""
+        answer = Answer.objects.get(question__slug='favourite-colour', slug='red')
+        answer.score = 15
+        answer.save()
+        out = StringIO()
+        call_command('rescore_submissions', batch_size=2, stdout=out)
+        self.assertTrue("6 rescored, 1 changed" in out.getvalue(), out.getvalue())
+        Submission.objects.get(question='favourite-colour', answer='red', score=15)
+        Submission.objects.get(question='favourite-colour', answer='blue', score=30)
+
+    def test_rescore_filters(self):
+        answer = Answer.objects.get(question__slug='favourite-colour', slug='red')
+        answer.score = 15
+        answer.save()
+        call_command('rescore_submissions', questions='favourite-sport', stdout=StringIO())
+        Submission.objects.get(question='favourite-colour', answer='red', score=10)
+        call_command('rescore_submissions', questions='favourite-colour', dry_run=True, stdout=StringIO())
+        Submission.objects.get(question='favourite-colour', answer='red', score=10)
+
+
+class ExportSubmissionsTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def test_export_csv(self):
+        out = StringIO()
+        call_command('export_submissions', chunk_size=4, stdout=out)
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[2]['username'], 'uncle_bill')
+        self.assertEqual(rows[2]['answer'], 'football,rugby,cricket')
+        self.assertEqual(rows[2]['answer_titles'], 'Football; Rugby; Cricket')
+        self.assertEqual(rows[5]['answer_titles'], '')
+
+    def test_export_ndjson_filters(self):
+        Question.objects.get(slug='favourite-sport').tags.add('sports')
+        Question.objects.get(slug='sports-you-play').tags.add('sports')
+        out = StringIO()
+        call_command('export_submissions', format='ndjson', tags='sports', users='1',
+                stdout=out)
+        rows = [simplejson.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([r['question'] for r in rows], ['favourite-sport', 'sports-you-play'])
+        self.assertEqual(rows[0]['answer_titles'], ['Football'])
+
+        out = StringIO()
+        call_command('export_submissions', format='ndjson', modified_since='2100-01-01',
+                stdout=out)
+        self.assertEqual(out.getvalue(), '')
+
+    def test_export_gzip(self):
+        out = StringIO()
+        call_command('export_submissions', format='ndjson', gzip=True, stdout=out)
+        lines = gzip.GzipFile(fileobj=StringIO(out.getvalue())).read().splitlines()
+        self.assertEqual(len(lines), 6)
+
+
+class LoadQuestionTagsTest(TestCase):
+    fixtures = ['submission_test']
+
+    def setUp(self):
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-sport').tags.add('favourites', 'sports')
+
+    def load(self, data, **options):
+        f = tempfile.NamedTemporaryFile()
+        f.write(simplejson.dumps(data))
+        f.flush()
+        out = StringIO()
+        call_command('load_question_tags', f.name, stdout=out, **options)
+        f.close()
+        return out.getvalue()
+
+    def tags(self, slug):
+        return sorted(Question.objects.get(slug=slug).tags.values_list('name', flat=True))
+
+    def test_load_diff(self):
+        through = Question._meta.get_field('tags').through
+        kept = through.objects.get(object_id=Question.objects.get(slug='favourite-sport').pk,
+                                   tag__name='sports').pk
+        out = self.load({
+            'favourite-colour': ['favourites'],
+            'favourite-sport': ['sports', 'ball-games'],
+            'sports-you-play': ['sports'],
+            'no-such-question': ['sports'],
+        }, batch_size=2)
+        self.assertTrue("3 questions, 2 changed: 2 tags added, 1 removed, "
+                "1 new tags, 1 missing questions" in out, out)
+        self.assertEqual(self.tags('favourite-colour'), ['favourites'])
+        self.assertEqual(self.tags('favourite-sport'), ['ball-games', 'sports'])
+        self.assertEqual(self.tags('sports-you-play'), ['sports'])
+        # unchanged tags are left alone rather than deleted and re-added
+        through.objects.get(pk=kept)
+        self.assertEqual(catalog.get('sports-you-play').tags, frozenset(['sports']))
+
+    def test_dry_run(self):
+        out = self.load({'favourite-colour': [], 'favourite-team': ['new']}, dry_run=True)
+        self.assertTrue(out.startswith("Dry run: 2 questions, 2 changed"), out)
+        self.assertEqual(self.tags('favourite-colour'), ['favourites'])
+        self.assertEqual(self.tags('favourite-team'), [])
+
+    def test_streaming_reader(self):
+        from cms_saq.management.commands.load_question_tags import JSONObjectReader
+        data = {'a': ['x', 'y'], 'b': [], 'c': {'n': 12345}}
+        reader = JSONObjectReader(StringIO(simplejson.dumps(data, indent=2)), read_size=3)
+        self.assertEqual(dict(reader), data)
+        self.assertEqual(list(JSONObjectReader(StringIO(' { } '))), [])
+        self.assertRaises(ValueError, list, JSONObjectReader(StringIO('{"a": [1,')))
+
+    def test_dump(self):
+        """The dump matches serialising the whole dict, in one query."""
+        # sorted case-sensitively, as sort_keys does
+        Question.objects.get(slug='favourite-team').tags.add('Zebras', 'apples')
+        expected = dict((q.slug, sorted(q.tags.values_list('name', flat=True)))
+                        for q in Question.objects.all())
+        ContentType.objects.get_for_model(Question)
+        out = StringIO()
+        with self.assertNumQueries(1):
+            call_command('dump_question_tags', stdout=out)
+        self.assertEqual(out.getvalue(), simplejson.dumps(expected, indent=2, sort_keys=True))
+
+        out = StringIO()
+        call_command('dump_question_tags', tag_prefix='sp', stdout=out)
+        self.assertEqual(simplejson.loads(out.getvalue()),
+                         {'favourite-sport': ['favourites', 'sports']})
+        out = StringIO()
+        call_command('dump_question_tags', tag_prefix='none', stdout=out)
+        self.assertEqual(out.getvalue(), '{}')
+
+
+class QuestionTreeTest(TestCase):
+    fixtures = ['scores_test']
+
+    def setUp(self):
+        # cms.api loads the plugin pool, which queries pages on import
+        from cms.api import create_page, add_plugin
+        self.root = create_page('Root', 'empty.html', 'en')
+        self.child = create_page('Child', 'empty.html', 'en', parent=self.root)
+        self.other = create_page('Other', 'empty.html', 'en')
+        for page, slug, optional in ((self.root, 'favourite-colour', False),
+                                     (self.child, 'favourite-sport', False),
+                                     (self.child, 'favourite-team', True),
+                                     (self.other, 'sports-you-play', False)):
+            add_plugin(self._placeholder(page), 'SingleChoiceQuestionPlugin', 'en',
+                    slug=slug, optional=optional, question_type='S')
+        self.progress = add_plugin(self._placeholder(self.child), 'ProgressBarPlugin', 'en')
+
+    def _placeholder(self, page):
+        try:
+            return page.placeholders.get(slot='main')
+        except Placeholder.DoesNotExist:
+            return page.placeholders.create(slot='main')
+
+    def test_all_in_tree(self):
+        slugs = Question.all_in_tree(self.child).values_list('slug', flat=True)
+        self.assertEqual(sorted(slugs), ['favourite-colour', 'favourite-sport', 'favourite-team'])
+        slugs = Question.all_in_page(self.child).values_list('slug', flat=True)
+        self.assertEqual(sorted(slugs), ['favourite-sport', 'favourite-team'])
+
+    def test_progress_for_user(self):
+        bill = User.objects.get(username='uncle_bill')
+        rach = User.objects.get(username='auntie_rach')
+        self.assertEqual(self.progress.progress_for_user(bill), (2, 2))
+        self.progress.count_optional = True
+        self.assertEqual(self.progress.progress_for_user(rach), (3, 3))
+
+    def test_invalidation(self):
+        """Adding a question to a page shows up in the cached index."""
+        from cms.api import add_plugin
+        self.assertEqual(len(Question.all_in_tree(self.root)), 3)
+        add_plugin(self._placeholder(self.root), 'FreeTextQuestionPlugin', 'en',
+                slug='new-question', question_type='F')
+        self.assertEqual(len(Question.all_in_tree(self.root)), 4)
+
+
+class ProgressCounterTest(QuestionTreeTest):
+    """Runs the question tree tests against the progress counters."""
+
+    def setUp(self):
+        super(ProgressCounterTest, self).setUp()
+        self._counters = getattr(settings, 'SAQ_PROGRESS_COUNTERS', False)
+        settings.SAQ_PROGRESS_COUNTERS = True
+        call_command('rebuild_progress_counters', stdout=StringIO())
+
+    def tearDown(self):
+        settings.SAQ_PROGRESS_COUNTERS = self._counters
+
+    def test_incremental_update(self):
+        rach = User.objects.get(username='auntie_rach')
+        # the plugin's placeholder and page, then the counter
+        with self.assertNumQueries(3):
+            self.assertEqual(self.progress.progress_for_user(rach), (2, 2))
+        Submission.objects.save_batch(rach, [
+            Submission(user=rach, question='sports-you-play', answer='rugby', score=100),
+            Submission(user=rach, question='favourite-colour', answer='red', score=10),
+        ])
+        counter = ProgressCounter.objects.get(user=rach, tree_id=self.root.tree_id)
+        self.assertEqual((counter.answered_required, counter.answered_total), (2, 3))
+        counter = ProgressCounter.objects.get(user=rach, tree_id=self.other.tree_id)
+        self.assertEqual((counter.answered_required, counter.answered_total), (1, 1))
+
+    def test_incremental_update_without_upsert(self):
+        """Counters are created and updated without a native upsert too."""
+        import sqlite3
+        version = sqlite3.sqlite_version_info
+        sqlite3.sqlite_version_info = (3, 23, 1)
+        try:
+            self.test_incremental_update()
+        finally:
+            sqlite3.sqlite_version_info = version
+
+    def test_no_questions(self):
+        from cms.api import add_plugin
+        progress = add_plugin(self._placeholder(self.other), 'ProgressBarPlugin', 'en')
+        Question.objects.get(slug='sports-you-play').delete()
+        bill = User.objects.get(username='uncle_bill')
+        self.assertEqual(progress.progress_for_user(bill), (0, 0))
+
+
+class SubmissionLoaderTest(TestCase):
+    fixtures = ['scores_test']
+
+    def setUp(self):
+        from cms.api import create_page, add_plugin
+        self.page = create_page('Page', 'empty.html', 'en')
+        placeholder = self.page.placeholders.create(slot='main')
+        self.questions = {}
+        for slug, answers in (('favourite-colour', ['red', 'green', 'blue']),
+                              ('favourite-sport', ['football', 'cricket'])):
+            question = add_plugin(placeholder, 'SingleChoiceQuestionPlugin', 'en',
+                    slug=slug, question_type='S')
+            for i, answer in enumerate(answers):
+                Answer.objects.create(question=question, slug=answer, title=answer.title(), score=(i + 1) * 20)
+            self.questions[slug] = question
+        self.request = RequestFactory().get('/')
+        self.request.user = User.objects.get(username='uncle_bill')
+        self.request.current_page = self.page
+
+    def test_page_loaded_once(self):
+        """Everything on the current page comes from one query each."""
+        template = Template("{% load saq_tags %}"
+                "{% saq_raw_answer 'favourite-colour' %} "
+                "{% saq_nice_answer 'favourite-sport' %} "
+                "{% saq_percent_score 'favourite-sport' %}")
+        catalog.entries()
+        tree_index.questions_in_page(self.page)
+        with self.assertNumQueries(1):
+            out = template.render(RequestContext(self.request))
+        self.assertEqual(out, 'red Football 100')
+        loader = get_loader(self.request)
+        with self.assertNumQueries(1):
+            for question in self.questions.values():
+                loader.answers(question)
+        self.assertEqual([a.slug for a in loader.answers(self.questions['favourite-sport'])],
+                ['cricket', 'football'])
+
+    def test_plugin_render(self):
+        from cms_saq.cms_plugins import SingleChoiceQuestionPlugin
+        plugin = SingleChoiceQuestionPlugin()
+        context = plugin.render(RequestContext(self.request), self.questions['favourite-colour'], None)
+        self.assertEqual(context['submission'].answer, 'red')
+        self.assertEqual(len(context['answers']), 3)
+        with self.assertNumQueries(0):
+            context = plugin.render(RequestContext(self.request), self.questions['favourite-sport'], None)
+        self.assertEqual(context['submission'].answer, 'football')
+
+    def test_off_page_question(self):
+        loader = get_loader(self.request)
+        self.assertEqual(loader.submission('sports-you-play').answer, 'football,rugby,cricket')
+        self.assertEqual(loader.submission('favourite-team'), None)
+        with self.assertNumQueries(0):
+            loader.submission('favourite-team')
+
 
 class TemplateTagsTest(TestCase):
     fixtures = ['scores_test', 'submission_test']
@@ -187,3 +1291,184 @@ class TemplateTagsTest(TestCase):
         out = template.render(RequestContext(request))
         self.assertEqual(out, '67')
 
+
+
+class ReadReplicaTest(TestCase):
+    fixtures = ['scores_test', 'submission_test']
+
+    def setUp(self):
+        # a "replica" sharing the test database's connection, whose queries
+        # are logged separately
+        primary = connections['default']
+        primary.cursor()
+        connections.databases['replica'] = dict(primary.settings_dict)
+        self.replica = connections['replica']
+        self.replica.connection = primary.connection
+        self.replica.use_debug_cursor = True
+        self._replicas = getattr(settings, 'SAQ_READ_DATABASES', None)
+        settings.SAQ_READ_DATABASES = {'default': 'replica'}
+        self._routers = router.routers
+        router.routers = [SubmissionRouter()]
+        self.client = Client()
+        self.client.login(username='uncle_bill', password='password')
+
+    def tearDown(self):
+        router.routers = self._routers
+        settings.SAQ_READ_DATABASES = self._replicas
+        del connections._connections['replica']
+        del connections.databases['replica']
+
+    def scores(self):
+        resp = self.client.get(reverse('cms_saq_scores'), {'q': ['favourite-colour']})
+        return simplejson.loads(resp.content)['submissions']['favourite-colour']['answer']
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self.scores(), 'red')
+        self.assertEqual(len(self.replica.queries), 1)
+
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(username='uncle_bill')
+        submission_cache.invalidate_user(request.user)
+        template = Template("{% load saq_tags %}{% saq_raw_answer \"favourite-colour\" %}")
+        self.assertEqual(template.render(RequestContext(request)), 'red')
+        self.assertEqual(len(self.replica.queries), 2)
+
+    def test_replica_reads_not_cached(self):
+        """A replica may lag behind a submit from another session, so what
+        is read from it isn't shared through the cache."""
+        bill = User.objects.get(username='uncle_bill')
+        self.assertEqual(self.scores(), 'red')
+        self.assertEqual(cache.get(submission_cache._key(bill.pk)), None)
+        # a submit made elsewhere, which the replica hasn't caught up with
+        submission_cache.invalidate_user(bill)
+        self.assertEqual(self.scores(), 'red')
+        Submission.objects.filter(question='favourite-colour').update(answer='blue')
+        self.assertEqual(self.scores(), 'blue')
+        self.assertEqual(submission_cache.get(bill)['favourite-colour'][0], 'blue')
+
+    def test_sticks_to_primary_after_submit(self):
+        self.client.post(reverse('cms_saq_submit'), {'favourite-colour': 'blue'})
+        self.assertEqual(self.scores(), 'blue')
+        self.assertEqual(len(self.replica.queries), 0)
+
+        session = self.client.session
+        session[STICKY_SESSION_KEY] = 0
+        session.save()
+        submission_cache.invalidate_user(User.objects.get(username='uncle_bill'))
+        self.assertEqual(self.scores(), 'blue')
+        self.assertEqual(len(self.replica.queries), 1)
+
+    def test_writes_go_to_primary(self):
+        submission = Submission.objects.using('replica').get(
+                user__username='uncle_bill', question='favourite-colour')
+        queries = len(self.replica.queries)
+        submission.score = 11
+        submission.save()
+        self.assertEqual(len(self.replica.queries), queries)
+        self.assertEqual(Submission.objects.get(pk=submission.pk).score, 11)
+
+
+@unittest.skipUnless(getattr(settings, 'SAQ_SHARDS', None),
+        "run with --settings=settings_sharded to test sharding")
+class ShardingTest(TestCase):
+    multi_db = True
+    fixtures = ['submission_test']
+
+    def setUp(self):
+        self.users = [User.objects.create_user('user%d' % i, 'user%d@example.com' % i, 'password')
+                      for i in range(6)]
+        self.assertEqual(set([shard_for_user(u) for u in self.users]), set(settings.SAQ_SHARDS))
+        Question.objects.get(slug='favourite-colour').tags.add('favourites')
+        Question.objects.get(slug='favourite-sport').tags.add('favourites')
+        client = Client()
+        for i, user in enumerate(self.users):
+            client.login(username=user.username, password='password')
+            answers = {'favourite-colour': ['red', 'green', 'blue'][i % 3]}
+            if i % 2:
+                answers['favourite-sport'] = 'cricket'
+            r = client.post(reverse('cms_saq_submit'), answers)
+            self.assertEqual(r.status_code, 200, r.content)
+
+    def test_submissions_on_their_shard(self):
+        for user in self.users:
+            shard = shard_for_user(user)
+            for alias in settings.SAQ_SHARDS:
+                count = Submission.objects.using(alias).filter(user=user).count()
+                self.assertEqual(count, 1 + self.users.index(user) % 2 if alias == shard else 0)
+        self.assertEqual(SubmissionChoice.objects.answer_counts('favourite-colour'),
+                         {'red': 2, 'green': 2, 'blue': 2})
+
+    def test_reads(self):
+        user = self.users[2]
+        client = Client()
+        client.login(username=user.username, password='password')
+        resp = client.get(reverse('cms_saq_scores'), {'q': ['favourite-colour']})
+        self.assertEqual(simplejson.loads(resp.content)['submissions'],
+                         {'favourite-colour': {'answer': 'blue', 'score': 30}})
+
+        request = RequestFactory().get('/')
+        request.user = user
+        template = Template("{% load saq_tags %}{% saq_raw_answer \"favourite-colour\" %} "
+                "{% saq_aggregate_percent_score_by_tags \"favourites\" %}")
+        self.assertEqual(template.render(RequestContext(request)), 'blue 50')
+
+        scores = aggregate_scores_for_users_by_tags(self.users, ['favourites'])
+        self.assertEqual([int(round(scores[u.pk])) for u in self.users],
+                         [17, 83, 50, 67, 33, 100])
+
+        # distributions add up the users on every shard
+        call_command('refresh_score_distributions', stdout=StringIO())
+        self.assertAlmostEqual(ScoreDistribution.objects.percentile('tag', 'favourites', 50),
+                               100.0 * 2 / 6)
+
+    def test_commands(self):
+        self._rollups = getattr(settings, 'SAQ_SCORE_ROLLUPS', False)
+        settings.SAQ_SCORE_ROLLUPS = True
+        try:
+            call_command('rebuild_score_rollups', stdout=StringIO())
+            scores = aggregate_scores_for_users_by_tags(self.users, ['favourites'])
+            self.assertEqual([int(round(scores[u.pk])) for u in self.users],
+                             [17, 83, 50, 67, 33, 100])
+        finally:
+            settings.SAQ_SCORE_ROLLUPS = self._rollups
+        for user in self.users:
+            self.assertEqual(TagScoreRollup.objects.using(shard_for_user(user)).filter(
+                    user=user).count(), 1)
+
+        answer = Answer.objects.get(question__slug='favourite-colour', slug='red')
+        answer.score = 15
+        answer.save()
+        out = StringIO()
+        call_command('rescore_submissions', stdout=out)
+        self.assertTrue("Done: 9 rescored, 2 changed" in out.getvalue(), out.getvalue())
+
+        out = StringIO()
+        call_command('export_submissions', format='ndjson', stdout=out)
+        rows = [simplejson.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(sorted([(r['username'], r['question']) for r in rows])[:2],
+                         [('user0', 'favourite-colour'), ('user1', 'favourite-colour')])
+        self.assertEqual(len(rows), 9)
+
+        colour = Question.objects.get(slug='favourite-colour')
+        colour.slug = 'favourite-color'
+        colour.save()
+        self.assertEqual(sum([Submission.objects.using(alias).filter(
+                question='favourite-color').count() for alias in settings.SAQ_SHARDS]), 6)
+
+    def test_deletes(self):
+        user = self.users[1]
+        shard = shard_for_user(user)
+        choices = SubmissionChoice.objects.using(shard).filter(submission__user=user.pk)
+        self.assertEqual(choices.count(), 2)
+        user.delete()
+        self.assertEqual(Submission.objects.using(shard).filter(user=user.pk).count(), 0)
+        self.assertEqual(choices.count(), 0)
+
+        sport = Question.objects.get(slug='favourite-sport')
+        sport.delete()
+        submissions = [s for alias in settings.SAQ_SHARDS
+                       for s in Submission.objects.using(alias).filter(question='favourite-sport')]
+        self.assertEqual([s.question_ref_id for s in submissions], [None, None])
+        self.assertEqual(sum([SubmissionChoice.objects.using(alias).filter(
+                submission__question='favourite-sport').count()
+                for alias in settings.SAQ_SHARDS]), 0)
@@ -1,40 +1,66 @@
+import heapq
+import itertools
+import operator
 import re
 
 from django.http import HttpResponse, HttpResponseBadRequest
-from django.contrib.auth.decorators import login_required
-from django.views.decorators.http import require_POST, require_GET
-from django.views.decorators.cache import never_cache
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.views.decorators.http import require_POST, require_GET, condition
+from django.views.decorators.cache import cache_control, never_cache
 from django.utils import simplejson
 from django.conf import settings
 
-from cms_saq.models import Question, Answer, Submission
+from cms_saq.catalog import catalog, submission_cache, tag_index
+from cms_saq.models import Answer, Submission, score_submissions_by_tags
+from cms_saq.routers import read_database, shard_for_user, shards, stick_to_primary
 
 ANSWER_RE = re.compile(r'^[\w-]+(,[\w-]+)*$')
 
+# users per page of bulk_scores, by default and at most
+BULK_SCORES_LIMIT = 500
+BULK_SCORES_MAX_LIMIT = 5000
+# rows fetched from each shard for a page of bulk_scores, at most; Django
+# reads them all into memory before the first is streamed
+BULK_SCORES_MAX_ROWS = 20000
 
-@require_POST
-def _submit(request):
-    for question_slug, answers in request.POST.iteritems():
+
+def _score(post, questions):
+    """Validate and score every answer in ``post`` against the catalog
+    ``questions``, returning ``(submissions, None)`` or, for the first
+    invalid one, ``(None, response)``."""
+    submissions = []
+    for question_slug, answers in post.iteritems():
         # validate the question
-        try:
-            question = Question.objects.get(slug=question_slug)
-        except Question.DoesNotExist:
-            return HttpResponseBadRequest("Invalid question '%s'" % question_slug)
+        question = questions.get(question_slug)
+        if question is None:
+            return None, HttpResponseBadRequest("Invalid question '%s'" % question_slug)
         # check answers is a list of slugs
         if question.question_type != 'F' and not ANSWER_RE.match(answers):
-            return HttpResponseBadRequest("Invalid answers: %s" % answers)
+            return None, HttpResponseBadRequest("Invalid answers: %s" % answers)
         # validate and score the answer
         try:
             score = question.score(answers)
         except Answer.DoesNotExist:
-            return HttpResponseBadRequest("Invalid answer '%s:%s'" % (question_slug, answers))
-        # save!
-        filter_attrs = {'user': request.user, 'question': question_slug}
-        attrs = {'answer': answers, 'score': score}
-        rows = Submission.objects.filter(**filter_attrs).update(**attrs)
-        if not rows:
-            attrs.update(filter_attrs)
-            Submission.objects.create(**attrs)
+            return None, HttpResponseBadRequest(
+                    "Invalid answer '%s:%s'" % (question_slug, answers))
+        submissions.append((question_slug, answers, score))
+    return submissions, None
+
+@require_POST
+def _submit(request):
+    # validate and score everything before writing anything
+    submissions, error = _score(request.POST, catalog.entries())
+    if error is not None:
+        # the question or answer may be new, and this process not have
+        # heard yet: try once more against the database
+        submissions, error = _score(request.POST, catalog.reload())
+    if error is not None:
+        return error
+    # save!
+    Submission.objects.save_batch(request.user, [
+        Submission(user=request.user, question=question_slug, answer=answers, score=score)
+        for question_slug, answers, score in submissions])
+    stick_to_primary(request)
     return HttpResponse("OK")
 
 if getattr(settings, "SAQ_LAZYSIGNUP", False):
@@ -44,22 +70,152 @@ else:
     submit = login_required(_submit)
 
 
+def _submissions_modified(request):
+    if not hasattr(request, '_saq_modified'):
+        request._saq_modified = submission_cache.modified(request.user)
+    return request._saq_modified
+
+def _scores_etag(request):
+    # tag scores also change with the questions' max scores and tags
+    return '%s-%s' % (_submissions_modified(request), catalog.generation.current())
+
+
 @require_GET
-@never_cache
+# not never_cache, which would add a Last-Modified header that browsers send
+# back alongside the ETag, and then Django never answers with a 304
+@cache_control(no_cache=True, must_revalidate=True, max_age=0)
 @login_required
+@condition(etag_func=_scores_etag)
 def scores(request):
+    """The user's submissions to the questions in ``q``, and their percent
+    scores for each ``tag`` (a tag or comma-separated tags), with the
+    average of those as ``overall``."""
     slugs = request.GET.getlist('q')
-    if slugs == []:
+    tags = request.GET.getlist('tag')
+    if slugs == [] and tags == []:
         return HttpResponseBadRequest("No questions supplied")
-    submissions = Submission.objects.filter(user=request.user, question__in=slugs)
-    submissions = [[s.question, {'answer': s.answer, 'score': s.score}]
-            for s in submissions]
+    using = read_database(request, shard_for_user(request.user))
+    cached = submission_cache.get(request.user, using)
+    submissions = [[slug, {'answer': cached[slug][0], 'score': cached[slug][1]}]
+            for slug in slugs if slug in cached]
     data = {
         "questions": slugs,
         "submissions": dict(submissions),
         "complete": len(submissions) == len(slugs)
     }
+    if tags:
+        tag_scores = dict((tag, score_submissions_by_tags(cached, tag.split(',')))
+                          for tag in tags)
+        data["tags"] = tag_scores
+        data["overall"] = sum(tag_scores.values()) / len(tag_scores)
     return HttpResponse(simplejson.dumps(data), mimetype="application/json")
 
-# TODO benchmarking
 
+class _Rows(object):
+    """Iterates over one shard's rows, noting whether the query's LIMIT cut
+    them short and, if so, which user they stopped at."""
+
+    def __init__(self, rows, limit):
+        self.rows = rows
+        self.limit = limit
+        self.count = 0
+        self.last_user = None
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            self.last_user = row[0]
+            yield row
+
+    @property
+    def truncated(self):
+        return self.count == self.limit
+
+
+def _bulk_scores_lines(sources, questions, tags, limit):
+    """Yield an NDJSON line per user, then one giving the cursor for the next
+    page.  ``sources`` are ``_Rows`` over ``(user_id, question_id, answer,
+    score)`` ordered by user; each user's rows all come from one of them."""
+    maxima = dict((tag, tag_index.scored(tag.split(','))) for tag in tags)
+    rows = heapq.merge(*sources)
+    emitted, last, stopped = 0, None, False
+    for user_id, group in itertools.groupby(rows, operator.itemgetter(0)):
+        group = list(group)
+        # Past the end of a page cut short by its LIMIT, a source may be
+        # missing users, or some of a user's rows; leave them to the next page.
+        ends = [s.last_user for s in sources if s.truncated]
+        if ends and (user_id > min(ends) or
+                     (user_id == min(ends) and len(group) < len(questions))):
+            stopped = True
+            break
+        submissions = {}
+        percents = {}
+        for _, question_id, answer, score in group:
+            entry = questions[question_id]
+            submissions[entry.slug] = {'answer': answer, 'score': score,
+                                       'percent': entry.percent_score(score)}
+            percents[question_id] = entry.percent_score(score)
+        tag_scores = {}
+        for tag, tag_maxima in maxima.items():
+            if tag_maxima:
+                tag_scores[tag] = sum([percents.get(pk) or 0
+                                       for pk in tag_maxima]) / len(tag_maxima)
+            else:
+                tag_scores[tag] = 0
+        yield simplejson.dumps({'user_id': user_id, 'submissions': submissions,
+                                'tags': tag_scores}) + "\n"
+        emitted += 1
+        last = user_id
+        if emitted == limit:
+            stopped = True
+            break
+    if not stopped and [s for s in sources if s.truncated]:
+        stopped = True
+    yield simplejson.dumps({'next': last if stopped else None}) + "\n"
+
+
+@require_GET
+@never_cache
+@user_passes_test(lambda u: u.is_active and u.is_staff)
+def bulk_scores(request):
+    """Stream the submissions and percent scores of many users as NDJSON,
+    for staff.  Questions are given by slug (``q``) and by ``tag`` (a tag
+    or comma-separated tags), both repeatable.  Users come a page (up to
+    ``limit``) at a time in id order, optionally from ``from`` to ``to``;
+    pass the ``next`` from the last line of a page as ``after`` to get the
+    next page."""
+    entries = catalog.entries()
+    tags = request.GET.getlist('tag')
+    slugs = set(request.GET.getlist('q'))
+    for tag in tags:
+        slugs.update([slug for pk, slug, max_score
+                      in tag_index.questions(tag.split(','))])
+    questions = dict((entries[slug].pk, entries[slug]) for slug in slugs if slug in entries)
+    if not questions:
+        return HttpResponseBadRequest("No questions supplied")
+    try:
+        after = int(request.GET.get('after', int(request.GET.get('from', 1)) - 1))
+        to = request.GET.get('to')
+        to = int(to) if to else None
+        limit = int(request.GET.get('limit', BULK_SCORES_LIMIT))
+    except ValueError:
+        return HttpResponseBadRequest("from, to, after and limit must be integers")
+    if not 0 < limit <= BULK_SCORES_MAX_LIMIT:
+        return HttpResponseBadRequest("limit must be from 1 to %d" % BULK_SCORES_MAX_LIMIT)
+
+    # Each user has at most one row per question, so this many rows cover a
+    # page of users; one keyset query per shard fetches them.  Past
+    # BULK_SCORES_MAX_ROWS the page is cut short instead, but always holds
+    # at least one user's rows.
+    row_limit = min(limit * len(questions), max(BULK_SCORES_MAX_ROWS, len(questions)))
+    sources = []
+    for alias in shards():
+        submissions = Submission.objects.using(read_database(request, alias)).filter(
+                user__gt=after, question_ref__in=sorted(questions))
+        if to is not None:
+            submissions = submissions.filter(user__lte=to)
+        rows = submissions.order_by('user', 'question_ref').values_list(
+                'user', 'question_ref', 'answer', 'score')[:row_limit]
+        sources.append(_Rows(rows.iterator(), row_limit))
+    return HttpResponse(_bulk_scores_lines(sources, questions, tags, limit),
+            mimetype="application/x-ndjson")
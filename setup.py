@@ -13,7 +13,8 @@ setup(
     author='Maplecroft',
     author_email='james.rutherford@maplecroft.com',
     url='https://github.com/Maplecroft/django-cms-saq',
-    packages=['cms_saq', 'cms_saq.migrations', 'cms_saq.management', 'cms_saq.management.commands', 'cms_saq.templatetags'],
+    packages=['cms_saq', 'cms_saq.migrations', 'cms_saq.management', 'cms_saq.management.commands', 'cms_saq.templatetags', 'cms_saq.benchmarks'],
     license='LICENSE.txt',
+    extras_require={'cohort': ['numpy']},
     include_package_data = True,
 )
@@ -181,3 +181,6 @@ AUTHENTICATION_BACKENDS = (
 )
 
 SAQ_LAZYSIGNUP=True
+
+# only ever run in one process, with the default local-memory cache
+SAQ_ALLOW_LOCAL_CACHE=True
@@ -0,0 +1,16 @@
+# Settings for running the tests with submissions sharded across two extra
+# SQLite databases:
+#
+#     ./manage.py test cms_saq.ShardingTest --settings=settings_sharded
+from settings import *
+
+DATABASES = dict(DATABASES)
+for alias in ('shard_a', 'shard_b'):
+    DATABASES[alias] = dict(DATABASES['default'], NAME='%s.sqlite' % alias)
+
+DATABASE_ROUTERS = ['cms_saq.routers.SubmissionRouter']
+SAQ_SHARDS = ['shard_a', 'shard_b']
+
+# Some django-cms migrations query the default database whichever one they
+# run against, so build the test databases with syncdb instead.
+SOUTH_TESTS_MIGRATE = False